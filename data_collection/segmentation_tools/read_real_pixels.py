@@ -8,14 +8,19 @@ import os
 import struct
 import zlib
 import json
+import hashlib
+import numpy as np
+
+# Cache su disco delle statistiche pixel (evita di ri-decodificare il PNG)
+CACHE_DIR = ".segmentation_cache"
 
 def read_png_pixels(filename):
-    """Legge pixel da PNG senza PIL"""
+    """Legge pixel da PNG senza PIL come array numpy HxW uint8"""
     try:
         with open(filename, 'rb') as f:
             # Verifica PNG signature
             signature = f.read(8)
-            if signature != b'\\x89PNG\\r\\n\\x1a\\n':
+            if signature != b'\x89PNG\r\n\x1a\n':
                 print("❌ Non è un file PNG valido")
                 return None
             
@@ -65,37 +70,76 @@ def read_png_pixels(filename):
                 print("❌ Errore decompressione")
                 return None
             
-            # Estrai pixel (semplificato per grayscale)
-            pixels = []
+            # Estrai pixel (semplificato per grayscale) come array HxW uint8
+            if color_type not in (0, 2):
+                print(f"❌ color_type {color_type} non supportato (solo grayscale/RGB)")
+                return None
+            
             bytes_per_pixel = 1 if color_type == 0 else 3  # 0=grayscale, 2=RGB
             bytes_per_row = width * bytes_per_pixel + 1  # +1 per filter byte
             
-            for y in range(height):
-                row_start = y * bytes_per_row + 1  # +1 per saltare filter byte
-                for x in range(width):
-                    if color_type == 0:  # Grayscale
-                        pixel_idx = row_start + x
-                        if pixel_idx < len(raw_data):
-                            pixels.append(raw_data[pixel_idx])
-                    elif color_type == 2:  # RGB - prendi solo canale R
-                        pixel_idx = row_start + x * 3
-                        if pixel_idx < len(raw_data):
-                            pixels.append(raw_data[pixel_idx])
+            # Vista sulle righe complete, senza copiare i dati decompressi
+            full_rows = min(height, len(raw_data) // bytes_per_row)
+            rows = np.frombuffer(raw_data, dtype=np.uint8, count=full_rows * bytes_per_row)
+            rows = rows.reshape(full_rows, bytes_per_row)
+            
+            # Salta il filter byte; per RGB prendi solo il canale R
+            pixels = rows[:, 1::bytes_per_pixel][:, :width]
             
-            return pixels
+            return np.ascontiguousarray(pixels)
             
     except Exception as e:
         print(f"❌ Errore lettura PNG: {e}")
         return None
 
-def analyze_pixels(pixels):
-    """Analizza i pixel per trovare valori unici"""
-    if not pixels:
+def count_pixel_values(pixels):
+    """Conta le occorrenze di ogni valore grigio (array 1D o 2D) in un solo passaggio"""
+    counts = np.bincount(np.asarray(pixels, dtype=np.uint8).ravel(), minlength=256)
+    return {int(val): int(counts[val]) for val in np.flatnonzero(counts)}
+
+def _stats_cache_path(filename):
+    """Percorso cache legato a path, mtime e dimensione del file"""
+    st = os.stat(filename)
+    key = hashlib.sha1(f"{filename}|{st.st_mtime_ns}|{st.st_size}".encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.json")
+
+def load_pixel_counts(filename):
+    """Legge le frequenze dei pixel, usando la cache se il file non è cambiato"""
+    cache_path = _stats_cache_path(filename)
+    
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r') as f:
+                cached = json.load(f)
+            print(f"⚡ Statistiche caricate dalla cache: {cache_path}")
+            # JSON salva le chiavi come stringhe
+            return {int(val): count for val, count in cached.items()}
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Cache non valida, rileggo il PNG: {e}")
+    
+    pixels = read_png_pixels(filename)
+    if pixels is None or pixels.size == 0:
+        return None
+    
+    value_counts = count_pixel_values(pixels)
+    
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(cache_path, 'w') as f:
+            json.dump(value_counts, f)
+    except OSError as e:
+        print(f"⚠️ Impossibile scrivere la cache: {e}")
+    
+    return value_counts
+
+def analyze_pixels(value_counts):
+    """Analizza le frequenze dei pixel per trovare valori unici"""
+    if not value_counts:
         return []
     
     # Trova valori unici
-    unique_values = sorted(list(set(pixels)))
-    total_pixels = len(pixels)
+    unique_values = sorted(value_counts)
+    total_pixels = sum(value_counts.values())
     
     print(f"\\n🔍 ANALISI PIXEL:")
     print(f"📊 Pixel totali: {total_pixels}")
@@ -103,16 +147,16 @@ def analyze_pixels(pixels):
     print(f"📋 Range: {min(unique_values)} - {max(unique_values)}")
     print(f"📝 Tutti i valori: {unique_values}")
     
-    # Conta frequenze
+    # Mostra frequenze
     print(f"\\n📈 DISTRIBUZIONE:")
-    value_counts = {}
+    stats_by_value = {}
     for val in unique_values:
-        count = pixels.count(val)
+        count = value_counts[val]
         percentage = (count / total_pixels) * 100
-        value_counts[val] = {'count': count, 'percentage': percentage}
+        stats_by_value[val] = {'count': count, 'percentage': percentage}
         
     # Mostra top 15
-    sorted_by_freq = sorted(value_counts.items(), key=lambda x: x[1]['count'], reverse=True)
+    sorted_by_freq = sorted(stats_by_value.items(), key=lambda x: x[1]['count'], reverse=True)
     print(f"{'Grigio':>6} {'Pixel':>8} {'%':>6}")
     print("-" * 22)
     for val, stats in sorted_by_freq[:15]:
@@ -120,8 +164,10 @@ def analyze_pixels(pixels):
     
     return unique_values
 
-def smart_categorize(unique_values):
+def smart_categorize(values):
     """Categorizzazione intelligente basata su valori AirSim tipici"""
+    # Accetta sia la lista dei valori unici sia l'array completo dei pixel
+    unique_values = np.unique(values).tolist()
     categories = {
         'sky': [],
         'trees': [],
@@ -157,8 +203,9 @@ def smart_categorize(unique_values):
     
     return categories
 
-def interactive_categorize(unique_values):
+def interactive_categorize(values):
     """Categorizzazione interattiva"""
+    unique_values = np.unique(values).tolist()
     categories = {
         'sky': [],
         'trees': [],
@@ -265,16 +312,16 @@ def main():
         print("💡 Assicurati di essere in data_collection/ e di aver generato la debug mask")
         return
     
-    # Leggi pixel reali
+    # Leggi pixel reali (o statistiche in cache)
     print("📖 Lettura pixel reali...")
-    pixels = read_png_pixels(filename)
+    value_counts = load_pixel_counts(filename)
     
-    if not pixels:
+    if not value_counts:
         print("❌ Impossibile leggere i pixel")
         return
     
     # Analizza
-    unique_values = analyze_pixels(pixels)
+    unique_values = analyze_pixels(value_counts)
     
     if not unique_values:
         print("❌ Nessun valore trovato")
@@ -13,6 +13,7 @@ from PIL import Image
 import os
 import json
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # Importazioni opzionali per features avanzate
 try:
@@ -23,6 +24,120 @@ except ImportError:
     HAS_OPENCV = False
     print("ℹ️ OpenCV non disponibile - usando solo PIL e numpy")
 
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+    print("✅ Numba disponibile - classificazione colori compilata")
+except ImportError:
+    HAS_NUMBA = False
+    print("ℹ️ Numba non disponibile - classificazione colori con numpy")
+
+# Kernel 3x3 per il conteggio dei vicini (pixel centrale incluso)
+NEIGHBOR_KERNEL = np.ones((3, 3), dtype=np.float32)
+
+# Area minima (pixel) di una regione connessa per non essere considerata rumore
+MIN_REGION_AREA = 9
+
+# Ordine di priorità e soglie di confidenza (colore × peso posizionale) usati in combine_analysis
+COMBINE_PRIORITY = ['buildings', 'trees', 'sky', 'ground']
+COMBINE_THRESHOLDS = [0.2, 0.25, 0.5, 0.2]
+
+def count_neighbors_3x3(binary_mask):
+    """Conta per ogni pixel quanti pixel attivi ci sono nel suo intorno 3x3 (fuori immagine = 0)"""
+    binary = binary_mask.astype(np.uint8)
+    if HAS_OPENCV:
+        return cv2.filter2D(binary, -1, NEIGHBOR_KERNEL, borderType=cv2.BORDER_CONSTANT)
+    
+    # Fallback numpy: somma delle 9 finestre traslate sull'immagine con padding a zero
+    h, w = binary.shape
+    padded = np.pad(binary, 1)
+    counts = np.zeros((h, w), dtype=np.uint8)
+    for dy in range(3):
+        for dx in range(3):
+            counts += padded[dy:dy + h, dx:dx + w]
+    return counts
+
+if HAS_NUMBA:
+    @njit(parallel=True, cache=True)
+    def _classify_pixels(img, sky, trees, buildings, ground):
+        """Kernel fuso: legge ogni pixel RGB una sola volta e scrive le 4 maschere di categoria"""
+        h, w = img.shape[0], img.shape[1]
+        for i in prange(h):
+            for j in range(w):
+                r = np.int32(img[i, j, 0])
+                g = np.int32(img[i, j, 1])
+                b = np.int32(img[i, j, 2])
+                
+                brightness = (r + g + b) / 3.0
+                max_rgb = max(r, g, b)
+                min_rgb = min(r, g, b)
+                uniformity = max_rgb - min_rgb
+                saturation = uniformity / max(max_rgb, 1)
+                
+                # CIELO
+                blue_sky = (b > r + 25) and (b > g + 20) and (b > 120) and (brightness > 110) and (saturation > 0.15)
+                gray_sky = (uniformity < 20) and (brightness > 170) and (saturation < 0.15) and (b >= r - 5) and (b >= g - 5)
+                white_sky = (r > 200) and (g > 200) and (b > 200) and (uniformity < 15) and (brightness > 200)
+                cloudy_sky = (brightness > 180) and (saturation < 0.2) and (b > r + 10) and (b > g + 10) and (uniformity < 25)
+                is_sky = blue_sky or gray_sky or white_sky or cloudy_sky
+                
+                # VEGETAZIONE
+                classic_green = (g > r + 10) and (g > b + 10) and (g > 60)
+                dark_green = (g > r + 5) and (g > b + 8) and (g > 30) and (brightness < 120)
+                bright_green = (g > r + 15) and (g > b + 20) and (g > 80) and (saturation > 0.2)
+                brown_trees = (r > g + 5) and (r > b + 15) and (g > b + 5) and (brightness > 40) and (brightness < 120) and (saturation > 0.2)
+                is_trees = classic_green or dark_green or bright_green or brown_trees
+                
+                # EDIFICI
+                concrete_gray = (uniformity < 50) and (brightness > 50) and (brightness < 190) and (saturation < 0.35)
+                red_brick = (r > g + 10) and (r > b + 15) and (r > 70) and (brightness > 50) and (brightness < 180)
+                colored_buildings = (saturation > 0.1) and (saturation < 0.7) and (brightness > 60) and (brightness < 190) and (uniformity < 60)
+                light_materials = (r > 140) and (g > 140) and (b > 140) and (brightness > 140) and (brightness < 220) and not is_sky
+                vertical_structures = (uniformity < 45) and (brightness > 40) and (brightness < 200) and (saturation < 0.5)
+                is_buildings = (concrete_gray or red_brick or colored_buildings or light_materials or vertical_structures) and not is_sky and not is_trees
+                
+                # TERRENO
+                asphalt = (uniformity < 30) and (brightness > 20) and (brightness < 120) and (saturation < 0.25)
+                soil = (r > g) and (r > b + 5) and (g > b) and (brightness > 40) and (brightness < 150) and (saturation > 0.1)
+                pavement = (uniformity < 40) and (brightness > 70) and (brightness < 160) and (saturation < 0.2)
+                dark_surfaces = (brightness < 80) and (saturation < 0.3) and (uniformity < 35)
+                is_ground = (asphalt or soil or pavement or dark_surfaces) and not is_sky and not is_trees and not is_buildings
+                
+                sky[i, j] = is_sky
+                trees[i, j] = is_trees
+                buildings[i, j] = is_buildings
+                ground[i, j] = is_ground
+    
+    @njit(parallel=True, cache=True)
+    def _lookup_rgb_lut(img, lut, sky, trees, buildings, ground):
+        """Legge ogni pixel RGB interleaved una volta, lo cerca nella LUT e scrive le 4 maschere"""
+        h, w = img.shape[0], img.shape[1]
+        for i in prange(h):
+            for j in range(w):
+                bits = lut[(np.uint32(img[i, j, 0]) << 16) | (np.uint32(img[i, j, 1]) << 8) | np.uint32(img[i, j, 2])]
+                sky[i, j] = (bits & 1) != 0
+                trees[i, j] = (bits & 2) != 0
+                buildings[i, j] = (bits & 4) != 0
+                ground[i, j] = (bits & 8) != 0
+    
+    @njit(parallel=True, cache=True)
+    def _first_strong_label(m0, m1, m2, m3, row_ok, values, out):
+        """Etichetta della prima categoria (in ordine di priorità) attiva su una riga abilitata, 0 altrimenti"""
+        h, w = out.shape
+        for i in prange(h):
+            ok0, ok1, ok2, ok3 = row_ok[0, i], row_ok[1, i], row_ok[2, i], row_ok[3, i]
+            for j in range(w):
+                if ok0 and m0[i, j]:
+                    out[i, j] = values[0]
+                elif ok1 and m1[i, j]:
+                    out[i, j] = values[1]
+                elif ok2 and m2[i, j]:
+                    out[i, j] = values[2]
+                elif ok3 and m3[i, j]:
+                    out[i, j] = values[3]
+                else:
+                    out[i, j] = 0
+
 class RealtimeObjectDetector:
     def __init__(self):
         """Inizializza detector semplificato con parametri ottimizzati"""
@@ -60,6 +175,59 @@ class RealtimeObjectDetector:
             }
         }
         
+        # Range HSV (H 0-179, S 0-255, V 0-255) per la classificazione con cv2.inRange:
+        # ogni categoria è l'unione di uno o più box (lower, upper). Approssimano le soglie RGB.
+        self.hsv_ranges = {
+            'sky': [
+                ((90, 30, 110), (130, 255, 255)),   # cielo blu
+                ((90, 0, 170), (130, 38, 255))      # cielo grigio/chiaro con tinta fredda
+            ],
+            'trees': [
+                ((35, 40, 30), (90, 255, 255)),     # vegetazione verde
+                ((10, 50, 40), (25, 255, 120))      # tronchi/marrone scuro
+            ],
+            'buildings': [
+                ((0, 0, 50), (179, 89, 190)),       # cemento/superfici poco sature
+                ((0, 90, 70), (10, 255, 180))       # mattoni rossi
+            ],
+            'ground': [
+                ((0, 0, 20), (179, 64, 120)),       # asfalto
+                ((5, 25, 40), (30, 255, 150)),      # terra/suolo
+                ((0, 0, 0), (179, 77, 80))          # superfici scure
+            ]
+        }
+        
+        # Statistiche di debug dei colori stampate ogni debug_every frame
+        self.debug_every = 10
+        self._dbg_ctr = 0
+        
+        # Pool per la classificazione a bande di righe (percorso senza numba):
+        # creato solo alla prima immagine abbastanza alta da essere divisa, chiuso da close()
+        self.n_workers = min(4, os.cpu_count() or 1)
+        self.min_band_rows = 64
+        self._executor = None
+        
+        # Metodo di classificazione colori:
+        # 'lut' = soglie RGB esatte via LUT (default), 'hsv' = cv2.inRange su HSV (approssimato, richiede OpenCV)
+        self.color_method = 'lut'
+        
+        # Fattore di riduzione per la segmentazione (1 = piena risoluzione)
+        # La segmentazione è euristica e già grossolana: a 1/4 il lavoro per frame cala di 16x
+        self.downscale_factor = 4
+        
+        # Cache dei pesi posizionali: dipendono solo dalla risoluzione (h, w)
+        self._pw_cache = {}
+        
+        # Piani di combinazione specializzati per risoluzione (vedi compile_for_shape)
+        self._shape_plans = {}
+        
+        # Buffer di lavoro riutilizzati tra i frame, uno per risoluzione (h, w)
+        self._scratch = {}
+        
+        # LUT colori: categoria precalcolata per ognuno dei 2^24 colori RGB
+        print("🎨 Precalcolo LUT colori RGB...")
+        self._rgb_lut = self.build_rgb_lut()
+        
         print("✅ Object Detector Semplificato inizializzato")
         
     def process_airsim_image(self, airsim_image):
@@ -74,18 +242,25 @@ class RealtimeObjectDetector:
             h, w = img_array.shape[:2]
             print(f"🔍 Processando immagine {w}x{h}")
             
+            # 0. RIDUZIONE: segmenta a risoluzione ridotta
+            work_array = self.downscale_image(img_array)
+            work_h, work_w = work_array.shape[:2]
+            
             # 1. ANALISI COLORI RGB
-            color_masks = self.analyze_colors_rgb(img_array)
+            color_masks = self.analyze_colors_rgb(work_array)
             
             # 2. ANALISI POSIZIONALE
-            position_weights = self.create_position_weights(h, w)
+            position_weights = self.create_position_weights(work_h, work_w)
             
             # 3. COMBINAZIONE INTELLIGENTE
-            semantic_mask = self.combine_analysis(color_masks, position_weights, h, w)
+            semantic_mask = self.combine_analysis(color_masks, position_weights, work_h, work_w)
             
             # 4. POST-PROCESSING SEMPLIFICATO
             semantic_mask = self.simple_post_process(semantic_mask)
             
+            # Riporta la maschera a piena risoluzione (nearest: niente etichette interpolate)
+            semantic_mask = self.upscale_mask(semantic_mask, h, w)
+            
             # 5. STATISTICHE
             stats = self.calculate_statistics(semantic_mask)
             
@@ -100,6 +275,7 @@ class RealtimeObjectDetector:
                 'debug_info': {
                     'processing_method': 'simplified_rgb_analysis',
                     'opencv_available': HAS_OPENCV,
+                    'downscale_factor': self.downscale_factor,
                     'categories_detected': len([k for k, v in stats.items() if k > 0 and v > 100])
                 }
             }
@@ -127,42 +303,223 @@ class RealtimeObjectDetector:
                 'debug_info': {'error': str(e)}
             }
     
+    def downscale_image(self, img_array):
+        """Riduce l'immagine di downscale_factor per la segmentazione"""
+        factor = self.downscale_factor
+        h, w = img_array.shape[:2]
+        if factor <= 1 or h < factor or w < factor:
+            return img_array
+        
+        small_h, small_w = h // factor, w // factor
+        if HAS_OPENCV:
+            return cv2.resize(img_array, (small_w, small_h), interpolation=cv2.INTER_AREA)
+        return img_array[:small_h * factor:factor, :small_w * factor:factor]
+    
+    def upscale_mask(self, mask, h, w):
+        """Riporta la maschera semantica a (h, w) con interpolazione nearest"""
+        if mask.shape == (h, w):
+            return mask
+        if HAS_OPENCV:
+            return cv2.resize(mask, (w, h), interpolation=cv2.INTER_NEAREST)
+        
+        mask_h, mask_w = mask.shape
+        rows = np.arange(h) * mask_h // h
+        cols = np.arange(w) * mask_w // w
+        return mask[rows.reshape(-1, 1), cols]
+    
     def analyze_colors_rgb(self, img_array):
         """Analisi colori AGGRESSIVA per catturare meglio tutti gli oggetti"""
+        if self.color_method == 'hsv' and HAS_OPENCV and img_array.dtype == np.uint8:
+            sky_mask, trees_mask, buildings_mask, ground_mask = self.classify_colors_hsv(img_array)
+        # Per immagini uint8 tutte le soglie si riducono a una lettura nella LUT per pixel
+        elif img_array.dtype == np.uint8:
+            sky_mask, trees_mask, buildings_mask, ground_mask = self.classify_colors_lut(img_array)
+        else:
+            sky_mask, trees_mask, buildings_mask, ground_mask = self.classify_colors_numpy(img_array)
+        
+        color_masks = {
+            'sky': sky_mask,
+            'trees': trees_mask,
+            'buildings': buildings_mask,
+            'ground': ground_mask
+        }
+        
+        # DEBUG: Stampa statistiche per tuning
+        self._dbg_ctr = (self._dbg_ctr + 1) % self.debug_every  # 1 frame ogni debug_every
+        if self._dbg_ctr == 0:
+            n = sky_mask.size
+            print(f"[DEBUG COLORI] Sky: {np.count_nonzero(sky_mask)/n:.1%}, Trees: {np.count_nonzero(trees_mask)/n:.1%}, Buildings: {np.count_nonzero(buildings_mask)/n:.1%}, Ground: {np.count_nonzero(ground_mask)/n:.1%}")
+        
+        return color_masks
+    
+    def build_rgb_lut(self):
+        """Precalcola le categorie di tutti i colori RGB (bit: sky|trees<<1|buildings<<2|ground<<3)"""
+        # Con Numba il kernel fuso è il modo più veloce di valutare le soglie
+        classify = self.classify_colors_numba if HAS_NUMBA else self.classify_colors_numpy
+        lut = np.empty(1 << 24, dtype=np.uint8)
+        
+        # Blocchi di 16 valori di R per tutte le 65536 coppie (G, B): indice = R<<16 | G<<8 | B
+        block = np.empty((16, 1 << 16, 3), dtype=np.uint8)
+        block[:, :, 1:] = np.indices((256, 256), dtype=np.uint8).reshape(2, -1).T
+        for r_start in range(0, 256, 16):
+            block[:, :, 0] = np.arange(r_start, r_start + 16, dtype=np.uint8).reshape(-1, 1)
+            sky, trees, buildings, ground = classify(block)
+            bits = sky.view(np.uint8) | (trees.view(np.uint8) << 1) | (buildings.view(np.uint8) << 2) | (ground.view(np.uint8) << 3)
+            lut[r_start << 16:(r_start + 16) << 16] = bits.ravel()
+        
+        return lut
+    
+    def get_scratch_buffers(self, h, w):
+        """Buffer di lavoro allocati una volta per risoluzione e riutilizzati a ogni frame"""
+        scratch = self._scratch.get((h, w))
+        if scratch is None:
+            scratch = {
+                'sky': np.empty((h, w), dtype=bool),
+                'trees': np.empty((h, w), dtype=bool),
+                'buildings': np.empty((h, w), dtype=bool),
+                'ground': np.empty((h, w), dtype=bool),
+                'lut_index': np.empty((h, w), dtype=np.uint32),
+                'lut_bits': np.empty((h, w), dtype=np.uint8),
+                'bit_flag': np.empty((h, w), dtype=np.uint8),
+                'strong': np.empty((4, h, w), dtype=bool),
+                'first_strong': np.empty((h, w), dtype=np.intp)
+            }
+            self._scratch[(h, w)] = scratch
+        return scratch
+    
+    def classify_colors_lut(self, img_array):
+        """Classificazione colori con una sola lettura nella LUT RGB per pixel
+        
+        Le maschere restituite sono buffer riutilizzati: valide fino al frame successivo.
+        """
+        h, w = img_array.shape[:2]
+        scratch = self.get_scratch_buffers(h, w)
+        sky_mask = scratch['sky']
+        trees_mask = scratch['trees']
+        buildings_mask = scratch['buildings']
+        ground_mask = scratch['ground']
+        
+        if HAS_NUMBA:
+            # Una sola passata sul layout RGB interleaved, senza piani intermedi
+            _lookup_rgb_lut(img_array, self._rgb_lut, sky_mask, trees_mask, buildings_mask, ground_mask)
+            return sky_mask, trees_mask, buildings_mask, ground_mask
+        
+        # Senza numba: bande di righe indipendenti su un pool persistente
+        # (i ufunc NumPy rilasciano il GIL, quindi le bande girano davvero in parallelo)
+        bands = self.row_bands(h)
+        if len(bands) == 1:
+            self._lookup_lut_rows(img_array, scratch, 0, h)
+        else:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.n_workers)
+            list(self._executor.map(lambda band: self._lookup_lut_rows(img_array, scratch, *band), bands))
+        
+        return sky_mask, trees_mask, buildings_mask, ground_mask
+    
+    def close(self):
+        """Chiude il pool di thread della classificazione a bande (se è stato creato)"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+    
+    def row_bands(self, h):
+        """Divide le righe in bande contigue per i worker (niente split su immagini piccole)"""
+        n_bands = max(1, min(self.n_workers, h // self.min_band_rows))
+        edges = np.linspace(0, h, n_bands + 1).astype(int).tolist()
+        return list(zip(edges[:-1], edges[1:]))
+    
+    def _lookup_lut_rows(self, img_array, scratch, start, stop):
+        """Lookup LUT sulle righe [start, stop) scrivendo nelle viste dei buffer scratch"""
+        rows = slice(start, stop)
+        img = img_array[rows]
+        
+        # Indice R<<16 | G<<8 | B costruito in place (i canali uint8 vengono promossi al volo)
+        index = scratch['lut_index'][rows]
+        index[...] = img[:, :, 0]
+        index <<= 8
+        index |= img[:, :, 1]
+        index <<= 8
+        index |= img[:, :, 2]
+        # mode='clip': con il default 'raise' np.take bufferizza out (un'allocazione per frame)
+        bits = np.take(self._rgb_lut, index, out=scratch['lut_bits'][rows], mode='clip')
+        
+        flag = scratch['bit_flag'][rows]
+        for bit, name in ((1, 'sky'), (2, 'trees'), (4, 'buildings'), (8, 'ground')):
+            np.bitwise_and(bits, bit, out=flag)
+            np.not_equal(flag, 0, out=scratch[name][rows])
+    
+    def classify_colors_hsv(self, img_array):
+        """Classificazione colori approssimata con cv2.inRange su HSV (kernel OpenCV vettorizzati)"""
+        hsv = cv2.cvtColor(np.ascontiguousarray(img_array[:, :, :3]), cv2.COLOR_RGB2HSV)
+        
+        def in_ranges(category):
+            result = None
+            for lower, upper in self.hsv_ranges[category]:
+                box = cv2.inRange(hsv, lower, upper)
+                result = box if result is None else cv2.bitwise_or(result, box)
+            return result
+        
+        # Stessa logica di esclusione delle soglie RGB: cielo e vegetazione hanno la precedenza
+        sky = in_ranges('sky')
+        trees = cv2.bitwise_and(in_ranges('trees'), cv2.bitwise_not(sky))
+        taken = cv2.bitwise_or(sky, trees)
+        buildings = cv2.bitwise_and(in_ranges('buildings'), cv2.bitwise_not(taken))
+        taken = cv2.bitwise_or(taken, buildings)
+        ground = cv2.bitwise_and(in_ranges('ground'), cv2.bitwise_not(taken))
+        
+        return sky > 0, trees > 0, buildings > 0, ground > 0
+    
+    def classify_colors_numba(self, img_array):
+        """Classificazione colori con il kernel Numba fuso"""
         h, w = img_array.shape[:2]
-        color_masks = {}
+        img_u8 = np.ascontiguousarray(img_array[:, :, :3])
         
-        # Estrai canali RGB
-        r = img_array[:, :, 0].astype(np.float32)
-        g = img_array[:, :, 1].astype(np.float32)
-        b = img_array[:, :, 2].astype(np.float32)
+        sky_mask = np.empty((h, w), dtype=bool)
+        trees_mask = np.empty((h, w), dtype=bool)
+        buildings_mask = np.empty((h, w), dtype=bool)
+        ground_mask = np.empty((h, w), dtype=bool)
+        _classify_pixels(img_u8, sky_mask, trees_mask, buildings_mask, ground_mask)
+        
+        return sky_mask, trees_mask, buildings_mask, ground_mask
+    
+    def classify_colors_numpy(self, img_array):
+        """Classificazione colori con operazioni vettoriali numpy"""
+        h, w = img_array.shape[:2]
+        
+        # Estrai canali RGB come interi (int16 invece di float32: metà della banda)
+        r = img_array[:, :, 0].astype(np.int16)
+        g = img_array[:, :, 1].astype(np.int16)
+        b = img_array[:, :, 2].astype(np.int16)
         
         # Calcola metriche avanzate
-        brightness = (r + g + b) / 3
+        # Luminosità come somma dei canali: brightness > X  <=>  brightness_sum > 3*X
+        brightness_sum = r + g + b
         max_rgb = np.maximum(np.maximum(r, g), b)
         min_rgb = np.minimum(np.minimum(r, g), b)
         uniformity = max_rgb - min_rgb
         
-        # Saturazione approssimata
-        saturation = np.where(max_rgb > 0, (max_rgb - min_rgb) / max_rgb, 0)
+        # Saturazione approssimata (max-min)/max confrontata senza divisioni, in ventesimi:
+        # saturation > k/20  <=>  20*uniformity > k*max_rgb
+        # (pixel neri: uniformity=0, quindi con denominatore 1 la saturazione resta 0 senza np.where)
+        sat_den = np.maximum(max_rgb, 1)
+        uniformity20 = uniformity * 20
         
         # ANALISI CIELO - PIÙ RIGOROSA per evitare false positive
         sky_mask = np.zeros((h, w), dtype=bool)
         
         # Cielo blu: soglie più rigorose per evitare di prendere edifici
-        blue_sky = (b > r + 25) & (b > g + 20) & (b > 120) & (brightness > 110) & (saturation > 0.15)
+        blue_sky = (b > r + 25) & (b > g + 20) & (b > 120) & (brightness_sum > 330) & (uniformity20 > 3 * sat_den)
         
         # Cielo grigio: molto più rigoroso, solo aree molto uniformi e luminose
-        gray_sky = (uniformity < 20) & (brightness > 170) & (saturation < 0.15) & (b >= r - 5) & (b >= g - 5)
+        gray_sky = (uniformity < 20) & (brightness_sum > 510) & (uniformity20 < 3 * sat_den) & (b >= r - 5) & (b >= g - 5)
         
         # Cielo bianco/chiaro: soglie alzate per evitare edifici bianchi
-        white_sky = (r > 200) & (g > 200) & (b > 200) & (uniformity < 15) & (brightness > 200)
+        white_sky = (r > 200) & (g > 200) & (b > 200) & (uniformity < 15) & (brightness_sum > 600)
         
         # Cielo con nuvole: più conservativo, deve essere chiaramente celeste
-        cloudy_sky = (brightness > 180) & (saturation < 0.2) & (b > r + 10) & (b > g + 10) & (uniformity < 25)
+        cloudy_sky = (brightness_sum > 540) & (uniformity20 < 4 * sat_den) & (b > r + 10) & (b > g + 10) & (uniformity < 25)
         
         sky_mask = blue_sky | gray_sky | white_sky | cloudy_sky
-        color_masks['sky'] = sky_mask
         
         # ANALISI VEGETAZIONE - PIÙ AGGRESSIVA
         trees_mask = np.zeros((h, w), dtype=bool)
@@ -171,70 +528,69 @@ class RealtimeObjectDetector:
         classic_green = (g > r + 10) & (g > b + 10) & (g > 60)
         
         # Verde scuro (ombre/bosco)
-        dark_green = (g > r + 5) & (g > b + 8) & (g > 30) & (brightness < 120)
+        dark_green = (g > r + 5) & (g > b + 8) & (g > 30) & (brightness_sum < 360)
         
         # Verde saturo 
-        bright_green = (g > r + 15) & (g > b + 20) & (g > 80) & (saturation > 0.2)
+        bright_green = (g > r + 15) & (g > b + 20) & (g > 80) & (uniformity20 > 4 * sat_den)
         
         # Marrone degli alberi/tronchi
-        brown_trees = (r > g + 5) & (r > b + 15) & (g > b + 5) & (brightness > 40) & (brightness < 120) & (saturation > 0.2)
+        brown_trees = (r > g + 5) & (r > b + 15) & (g > b + 5) & (brightness_sum > 120) & (brightness_sum < 360) & (uniformity20 > 4 * sat_den)
         
         trees_mask = classic_green | dark_green | bright_green | brown_trees
-        color_masks['trees'] = trees_mask
         
         # ANALISI EDIFICI - PIÙ AGGRESSIVA per catturare quello che il cielo non deve prendere  
         buildings_mask = np.zeros((h, w), dtype=bool)
         
         # Grigio cemento: soglie ampliate per catturare più variazioni
-        concrete_gray = (uniformity < 50) & (brightness > 50) & (brightness < 190) & (saturation < 0.35)
+        concrete_gray = (uniformity < 50) & (brightness_sum > 150) & (brightness_sum < 570) & (uniformity20 < 7 * sat_den)
         
         # Mattoni rossi e strutture colorate
-        red_brick = (r > g + 10) & (r > b + 15) & (r > 70) & (brightness > 50) & (brightness < 180)
+        red_brick = (r > g + 10) & (r > b + 15) & (r > 70) & (brightness_sum > 150) & (brightness_sum < 540)
         
         # Superfici colorate edifici (più permissivo)
-        colored_buildings = (saturation > 0.1) & (saturation < 0.7) & (brightness > 60) & (brightness < 190) & (uniformity < 60)
+        colored_buildings = (uniformity20 > 2 * sat_den) & (uniformity20 < 14 * sat_den) & (brightness_sum > 180) & (brightness_sum < 570) & (uniformity < 60)
         
         # Materiali bianchi/chiari degli edifici (distinguere dal cielo)
-        light_materials = (r > 140) & (g > 140) & (b > 140) & (brightness > 140) & (brightness < 220) & ~sky_mask
+        light_materials = (r > 140) & (g > 140) & (b > 140) & (brightness_sum > 420) & (brightness_sum < 660) & ~sky_mask
         
         # Superfici verticali/strutture (based on position hints)
-        vertical_structures = (uniformity < 45) & (brightness > 40) & (brightness < 200) & (saturation < 0.5)
+        vertical_structures = (uniformity < 45) & (brightness_sum > 120) & (brightness_sum < 600) & (uniformity20 < 10 * sat_den)
         
         # Escludi vegetazione e cielo, ma sii aggressivo nel prendere tutto il resto
         buildings_mask = (concrete_gray | red_brick | colored_buildings | light_materials | vertical_structures) & ~sky_mask & ~trees_mask
-        color_masks['buildings'] = buildings_mask
         
         # ANALISI TERRENO - PIÙ AGGRESSIVA
         ground_mask = np.zeros((h, w), dtype=bool)
         
         # Asfalto/strade: grigio scuro
-        asphalt = (uniformity < 30) & (brightness > 20) & (brightness < 120) & (saturation < 0.25)
+        asphalt = (uniformity < 30) & (brightness_sum > 60) & (brightness_sum < 360) & (uniformity20 < 5 * sat_den)
         
         # Terra/suolo: marrone
-        soil = (r > g) & (r > b + 5) & (g > b) & (brightness > 40) & (brightness < 150) & (saturation > 0.1)
+        soil = (r > g) & (r > b + 5) & (g > b) & (brightness_sum > 120) & (brightness_sum < 450) & (uniformity20 > 2 * sat_den)
         
         # Cemento/pavimenti
-        pavement = (uniformity < 40) & (brightness > 70) & (brightness < 160) & (saturation < 0.2)
+        pavement = (uniformity < 40) & (brightness_sum > 210) & (brightness_sum < 480) & (uniformity20 < 4 * sat_den)
         
         # Superfici scure generiche
-        dark_surfaces = (brightness < 80) & (saturation < 0.3) & (uniformity < 35)
+        dark_surfaces = (brightness_sum < 240) & (uniformity20 < 6 * sat_den) & (uniformity < 35)
         
         # Escludi altre categorie
         ground_mask = (asphalt | soil | pavement | dark_surfaces) & ~sky_mask & ~trees_mask & ~buildings_mask
-        color_masks['ground'] = ground_mask
-        
-        # DEBUG: Stampa statistiche per tuning
-        if np.random.random() < 0.1:  # 10% delle volte
-            print(f"[DEBUG COLORI] Sky: {np.sum(sky_mask)/sky_mask.size:.1%}, Trees: {np.sum(trees_mask)/trees_mask.size:.1%}, Buildings: {np.sum(buildings_mask)/buildings_mask.size:.1%}, Ground: {np.sum(ground_mask)/ground_mask.size:.1%}")
         
-        return color_masks
+        return sky_mask, trees_mask, buildings_mask, ground_mask
     
     def create_position_weights(self, h, w):
-        """Crea pesi posizionali per ogni categoria"""
+        """Crea pesi posizionali per ogni categoria (calcolati una volta per risoluzione)"""
+        key = (h, w)
+        position_weights = self._pw_cache.get(key)
+        if position_weights is not None:
+            return position_weights
+        
         position_weights = {}
         
-        # Crea griglia Y normalizzata (0=top, 1=bottom)
-        y_grid = np.tile(np.linspace(0, 1, h).reshape(-1, 1), (1, w))
+        # Colonna Y normalizzata (0=top, 1=bottom): shape (h, 1), il broadcasting la estende a w colonne
+        # (float64 come prima: in float32 alcune righe di confine cambierebbero lato di soglia)
+        y_grid = np.linspace(0, 1, h).reshape(-1, 1)
         
         # Peso per cielo (più probabile in alto)
         sky_weight = np.maximum(0, 1.5 - 2 * y_grid)  # Alto peso in alto, decresce verso il basso
@@ -254,33 +610,53 @@ class RealtimeObjectDetector:
         buildings_weight = np.maximum(0, buildings_weight)
         position_weights['buildings'] = buildings_weight
         
+        self._pw_cache[key] = position_weights
         return position_weights
     
+    def compile_for_shape(self, h, w, position_weights):
+        """Specializza la combinazione per una risoluzione (calcolato al primo frame di ogni (h, w))
+        
+        Le maschere colore valgono 0/1 e i pesi dipendono solo dalla riga, quindi
+        maschera * peso > soglia equivale a maschera AND (peso della riga > soglia):
+        il confronto in virgola mobile per pixel diventa una tabella booleana per riga.
+        """
+        plan = self._shape_plans.get((h, w))
+        if plan is None:
+            row_ok = np.stack([
+                np.broadcast_to(position_weights[category], (h, 1))[:, 0] > threshold
+                for category, threshold in zip(COMBINE_PRIORITY, COMBINE_THRESHOLDS)
+            ])
+            priority_values = np.array([self.category_values[c] for c in COMBINE_PRIORITY], dtype=np.uint8)
+            plan = {'row_ok': row_ok, 'priority_values': priority_values}
+            self._shape_plans[(h, w)] = plan
+        return plan
+    
     def combine_analysis(self, color_masks, position_weights, h, w):
         """Combina analisi colori e posizione con logica ANTI-CONFLITTO SKY/BUILDINGS"""
-        final_mask = np.zeros((h, w), dtype=np.uint8)
-        
         # STRATEGIA ANTI-CONFLITTO: Prima identifica edifici, poi cielo
-        
-        # 1. PRIMA: Identifica edifici (priorità ALTA per evitare che il cielo li rubi)
-        buildings_confidence = color_masks['buildings'].astype(np.float32) * position_weights['buildings']
-        buildings_strong = buildings_confidence > 0.2  # Soglia bassa per catturare tutto
-        final_mask[buildings_strong] = self.category_values['buildings']
-        
-        # 2. SECONDO: Identifica vegetazione 
-        trees_confidence = color_masks['trees'].astype(np.float32) * position_weights['trees']
-        trees_strong = (trees_confidence > 0.25) & (final_mask == 0)
-        final_mask[trees_strong] = self.category_values['trees']
-        
-        # 3. TERZO: Identifica cielo (ma SOLO dove non ci sono già edifici/alberi)
-        sky_confidence = color_masks['sky'].astype(np.float32) * position_weights['sky']
-        sky_strong = (sky_confidence > 0.5) & (final_mask == 0)  # Soglia più alta per essere conservativi
-        final_mask[sky_strong] = self.category_values['sky']
-        
-        # 4. QUARTO: Identifica terreno 
-        ground_confidence = color_masks['ground'].astype(np.float32) * position_weights['ground']
-        ground_strong = (ground_confidence > 0.2) & (final_mask == 0)
-        final_mask[ground_strong] = self.category_values['ground']
+        # 1. PRIMA: edifici (priorità ALTA per evitare che il cielo li rubi), soglia bassa per catturare tutto
+        # 2. SECONDO: vegetazione
+        # 3. TERZO: cielo (SOLO dove non ci sono già edifici/alberi), soglia più alta per essere conservativi
+        # 4. QUARTO: terreno
+        plan = self.compile_for_shape(h, w, position_weights)
+        row_ok = plan['row_ok']
+        priority_values = plan['priority_values']
+        masks = [color_masks[category] for category in COMBINE_PRIORITY]
+        
+        if HAS_NUMBA:
+            # Un solo passaggio: prima categoria attiva su una riga abilitata
+            final_mask = np.empty((h, w), dtype=np.uint8)
+            _first_strong_label(*masks, row_ok, priority_values, final_mask)
+        else:
+            # Confidenze sopra soglia impilate in un unico tensore (C, H, W), nei buffer riutilizzati
+            scratch = self.get_scratch_buffers(h, w)
+            strong = scratch['strong']
+            for i, mask in enumerate(masks):
+                np.logical_and(mask, row_ok[i][:, None], out=strong[i])
+            
+            # argmax su booleani restituisce la prima categoria sopra soglia in ordine di priorità
+            first_strong = np.argmax(strong, axis=0, out=scratch['first_strong'])
+            final_mask = np.where(strong.any(axis=0), priority_values[first_strong], 0).astype(np.uint8)
         
         # 5. CORREZIONE: Risolvi conflitti sky/buildings nelle zone di confine
         final_mask = self.resolve_sky_building_conflicts(final_mask, color_masks, h, w)
@@ -308,27 +684,14 @@ class RealtimeObjectDetector:
         # Trova pixel classificati come cielo
         sky_pixels = (mask == sky_value)
         
-        # Per ogni pixel cielo, controlla se potrebbe essere un edificio
-        for y in range(h):
-            for x in range(w):
-                if sky_pixels[y, x]:
-                    # Se è nella parte bassa dell'immagine, probabilmente è un edificio
-                    if y > h * 0.4:  # Sotto il 40% dell'immagine
-                        # Controlla se ha caratteristiche di edificio
-                        if color_masks['buildings'][y, x]:
-                            mask[y, x] = buildings_value
-                    
-                    # Se ha molti vicini edifici, probabilmente è un edificio
-                    building_neighbors = 0
-                    for dy in [-1, 0, 1]:
-                        for dx in [-1, 0, 1]:
-                            ny, nx = y + dy, x + dx
-                            if 0 <= ny < h and 0 <= nx < w:
-                                if mask[ny, nx] == buildings_value:
-                                    building_neighbors += 1
-                    
-                    if building_neighbors >= 3:  # 3+ vicini edifici
-                        mask[y, x] = buildings_value
+        # Se è nella parte bassa dell'immagine (sotto il 40%) e ha caratteristiche di edificio
+        y_idx = np.arange(h).reshape(-1, 1)
+        low_building = (y_idx > h * 0.4) & color_masks['buildings']
+        
+        # Se ha molti vicini edifici (3+), probabilmente è un edificio
+        building_neighbors = count_neighbors_3x3(mask == buildings_value)
+        
+        mask[sky_pixels & (low_building | (building_neighbors >= 3))] = buildings_value
         
         return mask
     
@@ -338,39 +701,25 @@ class RealtimeObjectDetector:
         refined_mask = mask.copy()
         
         # REGOLA 1: Il cielo dovrebbe essere continuo nella parte superiore
-        sky_pixels = np.where(mask == self.category_values['sky'])
-        if len(sky_pixels[0]) > 0:
+        sky_value = self.category_values['sky']
+        sky_current = (mask == sky_value)
+        sky_rows = np.flatnonzero(sky_current.any(axis=1))
+        if len(sky_rows) > 0:
             # Trova la riga più bassa con cielo
-            sky_bottom = np.max(sky_pixels[0])
-            # Se il cielo è frammentato in alto, riempi i buchi
-            for y in range(0, min(sky_bottom + 10, h//3)):  # Solo nel terzo superiore
-                for x in range(w):
-                    if mask[y, x] == 0 and color_masks['sky'][y, x]:
-                        # Controlla se ha vicini cielo
-                        neighbors_sky = 0
-                        for dy in [-1, 0, 1]:
-                            for dx in [-1, 0, 1]:
-                                ny, nx = y + dy, x + dx
-                                if 0 <= ny < h and 0 <= nx < w:
-                                    if mask[ny, nx] == self.category_values['sky']:
-                                        neighbors_sky += 1
-                        if neighbors_sky >= 2:
-                            refined_mask[y, x] = self.category_values['sky']
+            sky_bottom = sky_rows[-1]
+            # Se il cielo è frammentato in alto, riempi i buchi (solo nel terzo superiore)
+            band_end = min(sky_bottom + 10, h // 3)
+            if band_end > 0:
+                # Candidati: pixel non classificati con colore da cielo
+                sky_candidates = (mask[:band_end] == 0) & color_masks['sky'][:band_end]
+                # Vicini cielo contati sulla banda più una riga sotto (per il bordo inferiore)
+                neighbors_sky = count_neighbors_3x3(sky_current[:band_end + 1])[:band_end]
+                refined_mask[:band_end][sky_candidates & (neighbors_sky >= 2)] = sky_value
         
         # REGOLA 2: Gli edifici dovrebbero avere forme più regolari
-        # Rimuovi piccoli cluster di edifici isolati
-        buildings_mask = (mask == self.category_values['buildings'])
-        if np.sum(buildings_mask) > 0:
-            # Usa morphological operations se OpenCV disponibile
-            if HAS_OPENCV:
-                buildings_binary = buildings_mask.astype(np.uint8) * 255
-                kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
-                # Close per connettere parti vicine
-                buildings_binary = cv2.morphologyEx(buildings_binary, cv2.MORPH_CLOSE, kernel)
-                # Open per rimuovere noise
-                buildings_binary = cv2.morphologyEx(buildings_binary, cv2.MORPH_OPEN, kernel)
-                refined_mask[buildings_mask] = 0  # Reset
-                refined_mask[buildings_binary > 0] = self.category_values['buildings']
+        # Rimuovi piccoli cluster di edifici isolati (componenti connesse, se OpenCV disponibile)
+        if HAS_OPENCV and np.any(mask == self.category_values['buildings']):
+            self.remove_small_regions(refined_mask, self.category_values['buildings'])
         
         # REGOLA 3: La vegetazione dovrebbe essere più compatta
         trees_mask = (mask == self.category_values['trees'])
@@ -393,64 +742,70 @@ class RealtimeObjectDetector:
             return self.numpy_post_process(semantic_mask)
     
     def numpy_post_process(self, semantic_mask):
-        """Post-processing usando solo numpy"""
+        """Post-processing usando solo numpy (in place)"""
         h, w = semantic_mask.shape
-        processed_mask = semantic_mask.copy()
+        # Nessuna copia: le categorie sono disgiunte, quindi azzerare i pixel di una
+        # categoria non cambia le maschere né i conteggi delle altre
+        processed_mask = semantic_mask
         
         # Filtro semplice: rimuovi pixel isolati
+        # (i pixel di bordo non vengono mai rimossi, come nel filtro originale)
+        interior = np.zeros((h, w), dtype=bool)
+        interior[1:h-1, 1:w-1] = True
+        
         for category_value in self.category_values.values():
             if category_value == 0:
                 continue
                 
             category_mask = (semantic_mask == category_value)
             
-            # Per ogni pixel di questa categoria, controlla i vicini
-            for y in range(1, h-1):
-                for x in range(1, w-1):
-                    if category_mask[y, x]:
-                        # Conta vicini della stessa categoria
-                        neighbors = semantic_mask[y-1:y+2, x-1:x+2]
-                        same_category_count = np.sum(neighbors == category_value)
-                        
-                        # Se ha pochi vicini della stessa categoria, rimuovilo
-                        if same_category_count < 3:  # Meno di 3 su 9 pixel
-                            processed_mask[y, x] = 0
+            # Conta vicini della stessa categoria (intorno 3x3, pixel incluso)
+            same_category_count = count_neighbors_3x3(category_mask)
+            
+            # Se ha pochi vicini della stessa categoria, rimuovilo (meno di 3 su 9 pixel)
+            processed_mask[category_mask & interior & (same_category_count < 3)] = 0
         
         return processed_mask
     
     def opencv_post_process(self, semantic_mask):
         """Post-processing avanzato con OpenCV"""
         try:
+            # Filtro di moda 3x3 sulla mappa di etichette: ogni pixel prende l'etichetta più
+            # frequente nel suo intorno (un filter2D per categoria, nessun ciclo sui pixel).
+            # Punteggio = 2 * conteggio + pixel stesso: a parità vince l'etichetta attuale
+            best_score = np.zeros(semantic_mask.shape, dtype=np.uint8)
+            best_label = semantic_mask.copy()
             for category_value in self.category_values.values():
-                if category_value == 0:
-                    continue
-                    
-                # Crea maschera binaria per questa categoria
-                category_mask = (semantic_mask == category_value).astype(np.uint8) * 255
-                
-                # Morphological operations
-                kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
-                
-                # Close piccoli buchi
-                category_mask = cv2.morphologyEx(category_mask, cv2.MORPH_CLOSE, kernel)
-                
-                # Rimuovi piccole regioni
-                category_mask = cv2.morphologyEx(category_mask, cv2.MORPH_OPEN, kernel)
-                
-                # Riapplica alla maschera finale
-                semantic_mask[category_mask > 0] = category_value
-                semantic_mask[(semantic_mask == category_value) & (category_mask == 0)] = 0
+                category_mask = (semantic_mask == category_value)
+                score = count_neighbors_3x3(category_mask) * 2 + category_mask
+                better = score > best_score
+                best_score[better] = score[better]
+                best_label[better] = category_value
             
+            semantic_mask[:] = best_label
             return semantic_mask
             
         except Exception as e:
             print(f"⚠️ Errore OpenCV post-processing: {e}")
             return self.numpy_post_process(semantic_mask)
     
+    def remove_small_regions(self, mask, category_value):
+        """Azzera (in place) le regioni connesse di una categoria più piccole di MIN_REGION_AREA"""
+        binary = (mask == category_value).astype(np.uint8)
+        _, labels, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+        
+        # Tabella label -> regione piccola (label 0 è lo sfondo)
+        is_small = stats[:, cv2.CC_STAT_AREA] < MIN_REGION_AREA
+        is_small[0] = False
+        if is_small.any():
+            mask[is_small[labels]] = 0
+        return mask
+    
     def calculate_statistics(self, semantic_mask):
         """Calcola statistiche e valida la segmentazione"""
-        unique_values, counts = np.unique(semantic_mask, return_counts=True)
-        stats = dict(zip(unique_values, counts))
+        # Conteggio in un solo passaggio O(N) (i valori sono piccoli interi, niente ordinamento)
+        counts = np.bincount(semantic_mask.ravel(), minlength=max(self.category_values.values()) + 1)
+        stats = {int(value): int(counts[value]) for value in np.flatnonzero(counts)}
         
         total_pixels = semantic_mask.size
         
@@ -482,23 +837,45 @@ class RealtimeObjectDetector:
         
         return stats
     
+    def bounding_box(self, binary_mask):
+        """Bounding box [x_min, y_min, x_max, y_max] (estremi inclusi) di una maschera non vuota
+        
+        Solo numpy (proiezioni su righe e colonne): usata da category_regions quando OpenCV manca.
+        """
+        rows = np.flatnonzero(binary_mask.any(axis=1))
+        cols = np.flatnonzero(binary_mask.any(axis=0))
+        return int(cols[0]), int(rows[0]), int(cols[-1]), int(rows[-1])
+    
+    def category_regions(self, category_mask):
+        """Regioni di una categoria come (x_min, y_min, x_max, y_max, area), estremi inclusi
+        
+        Con OpenCV una regione per ogni componente connessa (bbox e area in un solo passaggio),
+        altrimenti un'unica regione che copre tutta la categoria.
+        """
+        if HAS_OPENCV:
+            n, _, stats, _ = cv2.connectedComponentsWithStats(category_mask.astype(np.uint8), connectivity=8)
+            return [(int(x), int(y), int(x + bw - 1), int(y + bh - 1), int(area))
+                    for x, y, bw, bh, area in stats[1:n]]
+        
+        area = int(np.count_nonzero(category_mask))
+        if area == 0:
+            return []
+        return [(*self.bounding_box(category_mask), area)]
+    
     def generate_simple_detections(self, semantic_mask):
-        """Genera bounding boxes simulate semplici"""
+        """Genera bounding boxes simulate semplici (una per regione connessa)"""
         detections = []
         
         for category, value in self.category_values.items():
             if value == 0 or category == 'unknown':
                 continue
-                
-            # Trova pixel di questa categoria
-            category_pixels = np.where(semantic_mask == value)
             
-            if len(category_pixels[0]) > 500:  # Solo regioni significative
-                # Calcola bounding box
-                y_min, y_max = category_pixels[0].min(), category_pixels[0].max()
-                x_min, x_max = category_pixels[1].min(), category_pixels[1].max()
+            category_mask = (semantic_mask == value)
+            
+            for x_min, y_min, x_max, y_max, area in self.category_regions(category_mask):
+                if area <= 500:  # Solo regioni significative
+                    continue
                 
-                area = len(category_pixels[0])
                 confidence = min(0.9, area / (semantic_mask.size * 0.1))
                 
                 detections.append({
@@ -68,47 +68,49 @@ class SimpleObjectDetector:
         """Segmentazione SEMPLIFICATA - logica chiara e diretta"""
         h, w = img_array.shape[:2]
         
-        # Estrai canali RGB
-        r = img_array[:, :, 0].astype(np.float32)
-        g = img_array[:, :, 1].astype(np.float32) 
-        b = img_array[:, :, 2].astype(np.float32)
+        # Estrai canali RGB come interi (int16 invece di float32: metà dei byte letti/scritti)
+        r = img_array[:, :, 0].astype(np.int16)
+        g = img_array[:, :, 1].astype(np.int16)
+        b = img_array[:, :, 2].astype(np.int16)
         
-        # Crea griglia posizioni
+        # Crea colonna posizioni verticali (broadcast sulle colonne)
         y_pos = np.arange(h).reshape(-1, 1) / h  # 0 = top, 1 = bottom
-        x_pos = np.arange(w).reshape(1, -1) / w   # 0 = left, 1 = right
-        
-        # Inizializza maschera
-        mask = np.zeros((h, w), dtype=np.uint8)
         
         # 1. CIELO: Blu dominante + posizione alta
         is_blue = (b > r + 20) & (b > g + 15) & (b > 100)
         is_top_area = y_pos < 0.7  # Solo nel 70% superiore
-        sky_pixels = is_blue & is_top_area
-        mask[sky_pixels] = self.category_values['sky']
         
         # 2. VEGETAZIONE: Verde dominante
-        is_green = (g > r + 10) & (g > b + 10) & (g > 60) & (mask == 0)
-        mask[is_green] = self.category_values['trees']
+        is_green = (g > r + 10) & (g > b + 10) & (g > 60)
         
-        # 3. EDIFICI: Colori neutri/grigi + non cielo + non vegetazione
-        brightness = (r + g + b) / 3
+        # 3. EDIFICI: Colori neutri/grigi
+        # Luminosità come somma dei canali: brightness > X  <=>  brightness_sum > 3*X
+        brightness_sum = r + g + b
         is_neutral = (np.abs(r - g) < 30) & (np.abs(g - b) < 30) & (np.abs(r - b) < 30)
-        is_medium_bright = (brightness > 80) & (brightness < 200)
-        is_building = is_neutral & is_medium_bright & (mask == 0)
-        mask[is_building] = self.category_values['buildings']
+        is_medium_bright = (brightness_sum > 240) & (brightness_sum < 600)
         
         # 4. TERRENO: Tutto il resto che è scuro + posizione bassa
         is_bottom_area = y_pos > 0.6  # Solo nel 40% inferiore
-        is_dark = brightness < 100
-        is_ground = is_dark & is_bottom_area & (mask == 0)
-        mask[is_ground] = self.category_values['ground']
+        is_dark = brightness_sum < 300
+        
+        # Selezione in un solo passaggio: vince la prima condizione vera,
+        # quindi l'ordine cielo > vegetazione > edifici > terreno resta quello di priorità
+        conditions = [
+            is_blue & is_top_area,
+            is_green,
+            is_neutral & is_medium_bright,
+            is_dark & is_bottom_area
+        ]
+        choices = [np.uint8(self.category_values[c]) for c in ('sky', 'trees', 'buildings', 'ground')]
+        mask = np.select(conditions, choices, default=np.uint8(0))
         
         return mask
     
     def calculate_statistics(self, semantic_mask):
         """Calcola statistiche semplici"""
-        unique_values, counts = np.unique(semantic_mask, return_counts=True)
-        stats = dict(zip(unique_values, counts))
+        # Conteggio in un solo passaggio O(N) (i valori sono piccoli interi, niente ordinamento)
+        counts = np.bincount(semantic_mask.ravel(), minlength=max(self.category_values.values()) + 1)
+        stats = {int(value): int(counts[value]) for value in np.flatnonzero(counts)}
         
         total_pixels = semantic_mask.size
         
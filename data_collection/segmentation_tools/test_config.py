@@ -1,8 +1,49 @@
 #!/usr/bin/env python3
 """Test caricamento configurazione"""
 
+import copy
 import json
 import os
+import tempfile
+
+# Parser JSON veloce opzionale (fallback: json della libreria standard)
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# Parser On-Demand opzionale: converte in oggetti Python solo i campi letti
+try:
+    import simdjson
+    HAS_SIMDJSON = True
+    _SIMDJSON_PARSER = simdjson.Parser()
+except ImportError:
+    HAS_SIMDJSON = False
+
+# Campi del file di configurazione usati da load_pixel_config
+CONFIG_FIELDS = ('categories', 'image_info', 'total_categorized')
+
+# Cache delle configurazioni già lette: percorso -> (mtime_ns, categorie)
+_CONFIG_CACHE = {}
+
+def parse_config_fields(raw):
+    """Estrae dal JSON solo i campi usati, senza materializzare il resto del documento"""
+    if HAS_SIMDJSON:
+        doc = _SIMDJSON_PARSER.parse(raw)
+        data = {}
+        for key in CONFIG_FIELDS:
+            value = doc.get(key)
+            # Converte tutti i proxy (oggetti e array): se uno restasse vivo il parser
+            # condiviso non potrebbe analizzare il file candidato successivo
+            if isinstance(value, simdjson.Object):
+                value = value.as_dict()
+            elif isinstance(value, simdjson.Array):
+                value = value.as_list()
+            if value is not None:
+                data[key] = value
+        return data
+    return orjson.loads(raw) if HAS_ORJSON else json.loads(raw)
 
 def load_pixel_config():
     """Carica configurazione dai file pixel click JSON"""
@@ -13,56 +54,96 @@ def load_pixel_config():
         "segmentation_pixel_config.json"  # File alternativo
     ]
     
-    # Aggiungi anche file con timestamp
-    if os.path.exists(config_dir):
-        timestamped_files = [f for f in os.listdir(config_dir) 
-                           if f.startswith("segmentation_pixel_config_") and f.endswith(".json")]
-        # Ordina per timestamp (più recente prima) 
-        timestamped_files.sort(reverse=True)
-        possible_files.extend([os.path.join(config_dir, f) for f in timestamped_files])
+    # Aggiungi anche file con timestamp (un solo scandir: nome e tipo senza stat aggiuntivi)
+    try:
+        with os.scandir(config_dir) as it:
+            timestamped_entries = [e for e in it
+                                   if e.is_file(follow_symlinks=False)
+                                   and e.name.startswith("segmentation_pixel_config_") and e.name.endswith(".json")]
+    except OSError:
+        timestamped_entries = []
+    # Ordina per timestamp (più recente prima) 
+    timestamped_entries.sort(key=lambda e: e.name, reverse=True)
+    
+    # Percorsi completi calcolati una volta (le entry di scandir hanno già il percorso)
+    candidates = [os.path.join(config_dir, f) for f in possible_files]
+    candidates.extend(e.path for e in timestamped_entries)
     
     # Prova ogni file finché non ne trova uno valido
-    for relative_path in possible_files:
-        if not relative_path.startswith(config_dir):
-            config_file = os.path.join(config_dir, relative_path)
-        else:
-            config_file = relative_path
+    for config_file in candidates:
+        # Un solo stat: verifica esistenza e data di modifica insieme
+        try:
+            mtime = os.stat(config_file).st_mtime_ns
+        except OSError:
+            continue
+        
+        # File invariato dall'ultimo caricamento: niente rilettura né parsing
+        # (copia profonda: le modifiche del chiamante non alterano la cache)
+        cached = _CONFIG_CACHE.get(config_file)
+        if cached is not None and cached[0] == mtime:
+            return copy.deepcopy(cached[1])
+        
+        print(f"🔧 Tentativo caricamento configurazione da: {config_file}")
+        try:
+            with open(config_file, 'rb') as f:
+                raw = f.read()
+            data = parse_config_fields(raw)
             
-        if os.path.exists(config_file):
-            print(f"🔧 Tentativo caricamento configurazione da: {config_file}")
-            try:
-                with open(config_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
+            # Estrai le categorie dal JSON
+            if 'categories' in data:
+                config = data['categories']
+                print(f"✅ Configurazione JSON caricata: {list(config.keys())}")
+                
+                # Stampa info immagine se disponibile
+                if 'image_info' in data:
+                    info = data['image_info']
+                    print(f"   Immagine analizzata: {info.get('width', '?')}x{info.get('height', '?')}")
+                    print(f"   Valori unici: {info.get('unique_values', '?')}")
                 
-                # Estrai le categorie dal JSON
-                if 'categories' in data:
-                    config = data['categories']
-                    print(f"✅ Configurazione JSON caricata: {list(config.keys())}")
-                    
-                    # Stampa info immagine se disponibile
-                    if 'image_info' in data:
-                        info = data['image_info']
-                        print(f"   Immagine analizzata: {info.get('width', '?')}x{info.get('height', '?')}")
-                        print(f"   Valori unici: {info.get('unique_values', '?')}")
-                    
-                    # Stampa statistiche categorie
-                    total = data.get('total_categorized', sum(len(values) for values in config.values()))
-                    print(f"   Totale categorizzati: {total}")
-                    
-                    for cat, values in config.items():
-                        print(f"   {cat}: {len(values)} valori ({values[:3]}{'...' if len(values) > 3 else ''})")
-                    
-                    return config
-                else:
-                    print(f"⚠️ Campo 'categories' non trovato in {config_file}")
-                    
-            except Exception as e:
-                print(f"❌ Errore caricamento {config_file}: {e}")
-                continue
+                # Stampa statistiche categorie
+                total = data.get('total_categorized')
+                if total is None:
+                    total = sum(map(len, config.values()))
+                print(f"   Totale categorizzati: {total}")
+                
+                for cat, values in config.items():
+                    print(f"   {cat}: {len(values)} valori ({values[:3]}{'...' if len(values) > 3 else ''})")
+                
+                _CONFIG_CACHE[config_file] = (mtime, copy.deepcopy(config))
+                return config
+            else:
+                print(f"⚠️ Campo 'categories' non trovato in {config_file}")
+                
+        except Exception as e:
+            print(f"❌ Errore caricamento {config_file}: {e}")
+            continue
     
     print(f"ℹ️ Nessun file di configurazione trovato in {config_dir}")
     return None
 
+# Svuota la cache (es. per forzare la rilettura nei test)
+load_pixel_config.cache_clear = _CONFIG_CACHE.clear
+
+def test_invalid_candidate_fallback():
+    """Un file prioritario con 'categories' non valido non deve impedire il caricamento del successivo"""
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.makedirs(os.path.join(tmp_dir, "segmentation_tools"))
+        with open(os.path.join(tmp_dir, "segmentation_tools", "segmentation_config.json"), 'w') as f:
+            json.dump({"categories": [1, 2, 3], "image_info": [4, 5]}, f)
+        with open(os.path.join(tmp_dir, "segmentation_tools", "segmentation_pixel_config.json"), 'w') as f:
+            json.dump({"categories": {"sky": [1, 2], "trees": [3]}}, f)
+        
+        os.chdir(tmp_dir)
+        load_pixel_config.cache_clear()
+        try:
+            config = load_pixel_config()
+        finally:
+            os.chdir(previous_dir)
+            load_pixel_config.cache_clear()
+    
+    assert config == {"sky": [1, 2], "trees": [3]}
+
 if __name__ == "__main__":
     config = load_pixel_config()
     if config:
@@ -5,8 +5,41 @@ Mostra il colore grigio nel terminale per aiutare la categorizzazione
 """
 
 import os
+import sys
 import json
 import struct
+import numpy as np
+from PIL import Image
+
+# Parser JSON veloce opzionale (fallback: json della libreria standard)
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+def write_atomic(path, payload):
+    """Scrive i byte su un file temporaneo e lo sostituisce atomicamente al file finale"""
+    tmp_path = path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(payload)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+        # Dati su disco prima del rename: dopo un'interruzione di corrente il file non torna vuoto
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, path)
+    
+    # Su POSIX anche il rename va reso persistente sincronizzando la cartella
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
 class ColorfulCategorizer:
     def __init__(self, image_path="segmentation_debug.png"):
@@ -21,9 +54,26 @@ class ColorfulCategorizer:
         
         # Valori di esempio (modifica con i tuoi veri valori)
         self.gray_values = [0, 1, 2, 5, 10, 15, 25, 30, 45, 50, 60, 80, 100, 120, 150, 180, 200, 255]
+        self._gray_set = frozenset(self.gray_values)
+        
+        # Blocchi colorati precalcolati per tutti i 256 livelli di grigio
+        self._color_lut = tuple(self._build_block(v) for v in range(256))
+        # Stessi blocchi tra parentesi quadre, per evidenziare il valore corrente nel contesto
+        self._bracket_lut = tuple(f"[{block}]" for block in self._color_lut)
+        
+        # Categoria suggerita per ogni livello di grigio (indice in _cat_names)
+        self._cat_names = ('sky', 'trees', 'buildings', 'ground', 'unknown')
+        self._suggest_lut = bytes([
+            0 if v <= 10 else 1 if v <= 50 else 2 if v <= 120 else 3 if v <= 220 else 4
+            for v in range(256)
+        ])
         
     def show_gray_color(self, gray_value):
         """Mostra il colore grigio usando escape codes ANSI"""
+        return self._color_lut[gray_value]
+    
+    def _build_block(self, gray_value):
+        """Costruisce il blocco colorato ANSI per un valore grigio (0-255)"""
         # Converte valore grigio (0-255) in escape code per background
         # ANSI 256-color: 232-255 sono i grigi (24 livelli)
         ansi_gray = 232 + int((gray_value / 255) * 23)
@@ -38,21 +88,22 @@ class ColorfulCategorizer:
     
     def show_color_palette(self):
         """Mostra una palette di tutti i grigi da categorizzare"""
-        print("\\n🎨 PALETTE COLORI DA CATEGORIZZARE:")
-        print("=" * 60)
+        # Output accumulato in memoria e scritto con una sola write
+        buf = ["\\n🎨 PALETTE COLORI DA CATEGORIZZARE:\n", "=" * 60, "\n"]
         
         # Mostra in righe di 8 colori
         for i in range(0, len(self.gray_values), 8):
             row = self.gray_values[i:i+8]
             
             # Riga con i colori
-            color_row = " ".join(self.show_gray_color(val) for val in row)
-            print(f"   {color_row}")
+            color_row = " ".join([self._color_lut[val] for val in row])
+            buf.append(f"   {color_row}\n")
             
             # Riga con i numeri sotto (per riferimento)
-            number_row = " ".join(f"  {val:3d}  " for val in row)
-            print(f"   {number_row}")
-            print()
+            number_row = " ".join([f"  {val:3d}  " for val in row])
+            buf.append(f"   {number_row}\n\n")
+        
+        sys.stdout.write("".join(buf))
     
     def categorize_with_colors(self):
         """Categorizzazione interattiva con visualizzazione colori"""
@@ -73,11 +124,10 @@ class ColorfulCategorizer:
             context_values = self.gray_values[context_start:context_end]
             
             print("   📍 Contesto:")
-            context_row = " ".join(
-                f"[{self.show_gray_color(val)}]" if val == gray_val 
-                else self.show_gray_color(val)
+            context_row = " ".join([
+                (self._bracket_lut if val == gray_val else self._color_lut)[val]
                 for val in context_values
-            )
+            ])
             print(f"      {context_row}")
             
             # Suggerimento automatico
@@ -96,9 +146,8 @@ class ColorfulCategorizer:
                 elif response == 'auto':
                     # Auto-categorizza i restanti
                     remaining = self.gray_values[i:]
-                    for val in remaining:
-                        auto_cat = self.suggest_category(val)
-                        self.categories[auto_cat].append(val)
+                    for val, cat_idx in zip(remaining, self.suggest_category_indices(remaining)):
+                        self.categories[self._cat_names[cat_idx]].append(val)
                     print(f"✅ Auto-categorizzati {len(remaining)} valori restanti")
                     return True
                 elif response == 'done':
@@ -114,47 +163,43 @@ class ColorfulCategorizer:
     
     def suggest_category(self, gray_value):
         """Suggerisci categoria basata su valore grigio"""
-        if gray_value <= 10:
-            return 'sky'
-        elif 11 <= gray_value <= 50:
-            return 'trees'
-        elif 51 <= gray_value <= 120:
-            return 'buildings'
-        elif 121 <= gray_value <= 220:
-            return 'ground'
-        else:
-            return 'unknown'
+        return self._cat_names[self._suggest_lut[gray_value]]
+    
+    def suggest_category_indices(self, gray_values):
+        """Indici di categoria suggeriti (in _cat_names) per un array di valori grigi, in un solo gather"""
+        lut = np.frombuffer(self._suggest_lut, dtype=np.uint8)
+        return lut[np.asarray(gray_values, dtype=np.uint8)]
     
     def print_summary(self):
         """Stampa riassunto con colori"""
-        print(f"\\n📋 RIASSUNTO CATEGORIE:")
-        print("=" * 50)
+        # Output accumulato in memoria e scritto con una sola write
+        buf = ["\\n📋 RIASSUNTO CATEGORIE:\n", "=" * 50, "\n"]
         
         for category, values in self.categories.items():
             if values:
                 sorted_values = sorted(values)
                 
                 # Mostra nome categoria
-                print(f"\\n🏷️ {category.upper()}:")
+                buf.append(f"\\n🏷️ {category.upper()}:\n")
                 
                 # Mostra colori in questa categoria
-                color_row = " ".join(self.show_gray_color(val) for val in sorted_values)
-                print(f"   {color_row}")
+                color_row = " ".join([self._color_lut[val] for val in sorted_values])
+                buf.append(f"   {color_row}\n")
                 
                 # Mostra valori numerici
-                print(f"   Valori: {sorted_values}")
+                buf.append(f"   Valori: {sorted_values}\n")
         
         # Mostra non categorizzati
-        categorized = set()
-        for values in self.categories.values():
-            categorized.update(values)
+        categorized = set().union(*self.categories.values())
         
-        uncategorized = [val for val in self.gray_values if val not in categorized]
+        uncategorized = sorted(self._gray_set - categorized)
         if uncategorized:
-            print(f"\\n⚠️ NON CATEGORIZZATI:")
-            color_row = " ".join(self.show_gray_color(val) for val in uncategorized)
-            print(f"   {color_row}")
-            print(f"   Valori: {uncategorized}")
+            buf.append("\\n⚠️ NON CATEGORIZZATI:\n")
+            color_row = " ".join([self._color_lut[val] for val in uncategorized])
+            buf.append(f"   {color_row}\n")
+            buf.append(f"   Valori: {uncategorized}\n")
+        
+        sys.stdout.write("".join(buf))
     
     def save_config(self):
         """Salva configurazione finale"""
@@ -169,17 +214,21 @@ class ColorfulCategorizer:
             clean['obstacles'] = sorted(obstacles)
         
         # Salva JSON
-        with open('segmentation_visual_config.json', 'w') as f:
-            json.dump(clean, f, indent=2)
+        if HAS_ORJSON:
+            payload = orjson.dumps(clean, option=orjson.OPT_INDENT_2)
+        else:
+            payload = json.dumps(clean, indent=2).encode('utf-8')
+        write_atomic('segmentation_visual_config.json', payload)
         
-        # Salva Python
-        with open('segmentation_visual_config.py', 'w') as f:
-            f.write("# CONFIGURAZIONE SEGMENTAZIONE (Categorizzazione Visuale)\\n")
-            f.write("# Sostituisci in generate.py\\n\\n")
-            f.write("SEGMENTATION_CATEGORIES = {\\n")
-            for category, values in clean.items():
-                f.write(f"    '{category}': {values},\\n")
-            f.write("}\\n")
+        # Salva Python (contenuto costruito in memoria, una sola scrittura)
+        lines = [
+            "# CONFIGURAZIONE SEGMENTAZIONE (Categorizzazione Visuale)\\n",
+            "# Sostituisci in generate.py\\n\\n",
+            "SEGMENTATION_CATEGORIES = {\\n"
+        ]
+        lines.extend([f"    '{category}': {values},\\n" for category, values in clean.items()])
+        lines.append("}\\n")
+        write_atomic('segmentation_visual_config.py', "".join(lines).encode('utf-8'))
         
         print(f"\\n💾 CONFIGURAZIONE SALVATA:")
         print(f"   📄 segmentation_visual_config.json")
@@ -198,11 +247,22 @@ class ColorfulCategorizer:
             size = os.path.getsize(self.image_path)
             print(f"📁 Trovato {self.image_path} ({size} bytes)")
             
-            # Per ora usiamo valori di esempio, ma puoi aggiornare con i veri valori
-            print("💡 Usando valori di esempio. Aggiorna self.gray_values con i tuoi veri valori!")
+            # Maschera in scala di grigi come array uint8 (H, W)
+            with Image.open(self.image_path) as img:
+                mask = np.asarray(img.convert('L'), dtype=np.uint8)
+            
+            # Valori unici e relativi conteggi in un solo passaggio
+            values, counts = np.unique(mask, return_counts=True)
+            self.gray_values = values.tolist()
+            self._gray_set = frozenset(self.gray_values)
+            print(f"✅ {len(self.gray_values)} valori grigi unici in {mask.shape[1]}x{mask.shape[0]} pixel")
             
-            # Se hai i veri valori, aggiornali qui:
-            # self.gray_values = [i veri valori dalla tua immagine]
+            # Copertura per categoria suggerita (LUT applicata ai valori unici, pesata per i conteggi)
+            coverage = np.bincount(self.suggest_category_indices(values), weights=counts,
+                                   minlength=len(self._cat_names))
+            for name, pixels in zip(self._cat_names, coverage):
+                if pixels:
+                    print(f"   {name}: {pixels / mask.size:.1%} (suggerito)")
             
             return True
             
@@ -210,14 +270,15 @@ class ColorfulCategorizer:
             print(f"❌ Errore lettura file: {e}")
             return False
 
-def test_colors():
-    """Testa la visualizzazione colori"""
+def test_colors(categorizer=None):
+    """Testa la visualizzazione colori (riusa il categorizzatore passato, se presente)"""
     print("🧪 TEST VISUALIZZAZIONE COLORI:")
     print("=" * 40)
     
     test_values = [0, 25, 50, 75, 100, 125, 150, 175, 200, 225, 255]
     
-    categorizer = ColorfulCategorizer()
+    if categorizer is None:
+        categorizer = ColorfulCategorizer()
     
     for val in test_values:
         color_block = categorizer.show_gray_color(val)
@@ -230,11 +291,12 @@ def main():
     print("🎨 CATEGORIZZATORE VISUALE SEGMENTATION MASK")
     print("=" * 55)
     
+    # Inizializza (una sola istanza, condivisa con il test colori)
+    categorizer = ColorfulCategorizer()
+    
     # Test colori
-    test_colors()
+    test_colors(categorizer)
     
-    # Inizializza
-    categorizer = ColorfulCategorizer()
     categorizer.load_real_values_from_file()
     
     # Menu
@@ -1,19 +1,79 @@
 # data_collection/utils.py
 
-from PIL import ImageEnhance, ImageOps
+from PIL import Image, ImageEnhance, ImageOps
+from concurrent.futures import ThreadPoolExecutor, wait
+from collections import namedtuple
+import numpy as np
 import os
 
+try:
+    import cv2
+    HAS_OPENCV = True
+except ImportError:
+    HAS_OPENCV = False
+
+# pool condiviso per la codifica PNG (zlib rilascia il GIL)
+_SAVE_POOL = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
+
+# compressione zlib minima: codifica molto più rapida, file poco più grandi
+PNG_SAVE_OPTIONS = {'optimize': False, 'compress_level': 1}
+
+# matrici di rotazione per (w, h, angolo), calcolate una volta sola
+_ROTATION_CACHE = {}
+
+def rotate_array(arr, angle):
+    # rotazione antioraria attorno al centro, bilineare, bordi neri (come PIL rotate)
+    h, w = arr.shape[:2]
+    key = (w, h, angle)
+    M = _ROTATION_CACHE.get(key)
+    if M is None:
+        M = _ROTATION_CACHE[key] = cv2.getRotationMatrix2D(((w - 1) / 2, (h - 1) / 2), angle, 1.0)
+    return cv2.warpAffine(arr, M, (w, h), flags=cv2.INTER_LINEAR,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
 def transform_image(img, type='positive'):
+    if HAS_OPENCV and img.mode == 'RGB':
+        arr = np.asarray(img)
+        if type == 'positive':
+            arr = rotate_array(arr, 5)  # rotazione leggera
+            # contrasto 1.1 attorno alla luminanza media, come ImageEnhance.Contrast
+            mean = int(cv2.mean(cv2.cvtColor(arr, cv2.COLOR_RGB2GRAY))[0] + 0.5)
+            arr = cv2.addWeighted(arr, 1.1, arr, 0, -0.1 * mean)
+        elif type == 'negative':
+            return ImageOps.autocontrast(Image.fromarray(rotate_array(arr, 30)))
+        return Image.fromarray(arr)
+    
     if type == 'positive':
-        img = img.rotate(5)  # rotazione leggera
+        img = img.rotate(5, resample=Image.BILINEAR, expand=False)  # rotazione leggera
         enhancer = ImageEnhance.Contrast(img)
         img = enhancer.enhance(1.1)
     elif type == 'negative':
-        img = img.rotate(30)
+        img = img.rotate(30, resample=Image.BILINEAR, expand=False)
         img = ImageOps.autocontrast(img)
     return img
 
-def save_triplet(anchor, positive, negative, save_dir, idx):
-    anchor.save(os.path.join(save_dir, "anchor", f"img_{idx:04d}.png"))
-    positive.save(os.path.join(save_dir, "positive", f"img_{idx:04d}.png"))
-    negative.save(os.path.join(save_dir, "negative", f"img_{idx:04d}.png"))
+# percorsi delle sottocartelle di una tripletta, calcolati una volta sola
+TripletDirs = namedtuple('TripletDirs', ['anchor', 'positive', 'negative'])
+
+def make_triplet_dirs(save_dir):
+    dirs = TripletDirs(*(os.path.join(save_dir, name) for name in TripletDirs._fields))
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+    return dirs
+
+def save_triplet_async(anchor, positive, negative, dirs, idx):
+    # dirs: TripletDirs da make_triplet_dirs (accetta anche la cartella base come stringa)
+    if not isinstance(dirs, TripletDirs):
+        dirs = TripletDirs(*(os.path.join(dirs, name) for name in TripletDirs._fields))
+    # restituisce i future dei tre salvataggi, così più triplette possono sovrapporsi
+    return [
+        _SAVE_POOL.submit(anchor.save, f"{dirs.anchor}/img_{idx:04d}.png", **PNG_SAVE_OPTIONS),
+        _SAVE_POOL.submit(positive.save, f"{dirs.positive}/img_{idx:04d}.png", **PNG_SAVE_OPTIONS),
+        _SAVE_POOL.submit(negative.save, f"{dirs.negative}/img_{idx:04d}.png", **PNG_SAVE_OPTIONS),
+    ]
+
+def save_triplet(anchor, positive, negative, dirs, idx):
+    futures = save_triplet_async(anchor, positive, negative, dirs, idx)
+    wait(futures)
+    for future in futures:
+        future.result()  # propaga eventuali errori di salvataggio
@@ -6,71 +6,278 @@ Addestra un agente usando contrastive learning su anchor/positives
 """
 
 import os
+import copy
+import math
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torchvision.transforms as transforms
+from torchvision.io import read_file, decode_image, ImageReadMode
 from torch.utils.data import Dataset, DataLoader
-from PIL import Image
 import numpy as np
 import argparse
-import glob
 from pathlib import Path
 import matplotlib.pyplot as plt
 from datetime import datetime
 import torch._dynamo
 from torch.utils.data.dataloader import get_worker_info
 
+# Augmentation GPU a batch con Kornia (opzionale: altrimenti implementazione torch equivalente)
+try:
+    import kornia.augmentation as K
+    HAS_KORNIA = True
+except ImportError:
+    HAS_KORNIA = False
+
 # Ottimizzazione: Sopprime gli errori di compilazione (es. Triton su Windows) e torna all'esecuzione standard
 torch._dynamo.config.suppress_errors = True
 
 # Configurazione device
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+USE_CUDA = torch.cuda.is_available()
+device = torch.device('cuda' if USE_CUDA else 'cpu')
 print(f"Using device: {device}")
 
+def select_amp_dtype():
+    """bf16 su GPU che lo supportano (Ampere+): stesso esponente di fp32, niente loss scaling"""
+    # is_bf16_supported() è True anche con bf16 emulato (V100, T4, RTX 20xx): serve compute capability >= 8
+    if USE_CUDA and torch.cuda.get_device_capability()[0] >= 8 and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
+
+# Configurazione AMP calcolata una volta: autocast riceve costanti (nessun ramo Python per chiamata)
+AMP_DEVICE = 'cuda' if USE_CUDA else 'cpu'
+AMP_DTYPE = select_amp_dtype()
+
+# Statistiche ImageNet per la normalizzazione
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+def read_image_uint8(path):
+    """Decodifica un'immagine (PNG/JPEG) direttamente in un tensore uint8 (3, H, W), senza PIL"""
+    return decode_image(read_file(path), mode=ImageReadMode.RGB)
+
+def collate_uint8(batch):
+    """
+    Collate per immagini uint8: impila se hanno tutte la stessa dimensione,
+    altrimenti restituisce la lista (il ridimensionamento avviene su GPU)
+    """
+    collated = {'anchor_dir': [item['anchor_dir'] for item in batch],
+                'anchor_idx': torch.tensor([item['anchor_idx'] for item in batch])}
+    for key in ('anchor', 'positive'):
+        imgs = [item[key] for item in batch]
+        if all(img.shape == imgs[0].shape for img in imgs):
+            collated[key] = torch.stack(imgs)
+        else:
+            collated[key] = imgs
+    return collated
+
+def to_device(imgs):
+    """Sposta su device un batch uint8 (tensore impilato o lista di immagini)"""
+    # non_blocking: con pin_memory la copia H2D è asincrona e si sovrappone al calcolo
+    if isinstance(imgs, (list, tuple)):
+        return [img.to(device, non_blocking=True) for img in imgs]
+    return imgs.to(device, non_blocking=True)
+
+def pair_to_device(batch):
+    """
+    Anchor e positivi su device concatenati lungo il batch (2B): un solo preprocessing
+    e un solo forward per entrambi. La concatenazione avviene dopo la copia, per non
+    perdere il pinned memory.
+    """
+    anchors = to_device(batch['anchor'])
+    positives = to_device(batch['positive'])
+    if torch.is_tensor(anchors) and torch.is_tensor(positives) and anchors.shape[1:] == positives.shape[1:]:
+        return torch.cat([anchors, positives], dim=0)
+    return list(anchors) + list(positives)
+
+class GpuTransform(nn.Module):
+    """
+    Preprocessing a batch sul device: uint8 (B, 3, H, W) -> float normalizzato (B, 3, S, S)
+    Con augment=True applica per campione flip, rotazione e color jitter (come get_transforms)
+    """
+    def __init__(self, img_size=224, augment=False, degrees=5, brightness=0.1, contrast=0.1, saturation=0.1, hue=0.05):
+        super(GpuTransform, self).__init__()
+        self.img_size = img_size
+        self.augment = augment
+        self.degrees = degrees
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.register_buffer('mean', torch.tensor(IMAGENET_MEAN).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor(IMAGENET_STD).view(1, 3, 1, 1))
+        self.register_buffer('gray_weights', torch.tensor([0.299, 0.587, 0.114]).view(1, 3, 1, 1))
+        
+        # Con Kornia la pipeline completa (hue incluso) gira come kernel a batch sul device
+        self.kornia_augment = None
+        if augment and HAS_KORNIA:
+            self.kornia_augment = K.AugmentationSequential(
+                K.RandomHorizontalFlip(p=0.5),
+                K.RandomRotation(degrees=degrees, p=1.0),
+                K.ColorJitter(brightness, contrast, saturation, hue, p=1.0)
+            )
+    
+    def forward(self, imgs):
+        # Immagini di dimensioni diverse: ridimensiona una per una e impila
+        if isinstance(imgs, (list, tuple)):
+            return torch.cat([self(img.unsqueeze(0)) for img in imgs])
+        
+        x = imgs.float().div_(255)
+        x = F.interpolate(x, size=(self.img_size, self.img_size), mode='bilinear',
+                          align_corners=False, antialias=True)
+        if self.kornia_augment is not None:
+            x = self.kornia_augment(x)
+        elif self.augment:
+            x = self.random_augment(x)
+        # channels_last (NHWC): layout richiesto dai kernel conv Tensor Core di cuDNN
+        return ((x - self.mean) / self.std).contiguous(memory_format=torch.channels_last)
+    
+    def random_factor(self, x, amount):
+        """Fattore casuale per campione in [1 - amount, 1 + amount]"""
+        return 1 + (torch.rand(x.shape[0], 1, 1, 1, device=x.device) * 2 - 1) * amount
+    
+    def random_augment(self, x):
+        b = x.shape[0]
+        
+        # Flip orizzontale con p=0.5
+        flip = torch.rand(b, 1, 1, 1, device=x.device) < 0.5
+        x = torch.where(flip, x.flip(-1), x)
+        
+        # Rotazione casuale in [-degrees, +degrees] (riempimento nero, interpolazione nearest)
+        angle = (torch.rand(b, device=x.device) * 2 - 1) * math.radians(self.degrees)
+        cos, sin, zeros = angle.cos(), angle.sin(), torch.zeros_like(angle)
+        theta = torch.stack([torch.stack([cos, -sin, zeros], dim=1),
+                             torch.stack([sin, cos, zeros], dim=1)], dim=1)
+        grid = F.affine_grid(theta, list(x.shape), align_corners=False)
+        x = F.grid_sample(x, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+        
+        # Color jitter: luminosità, contrasto (attorno al grigio medio), saturazione
+        x = (x * self.random_factor(x, self.brightness)).clamp_(0, 1)
+        gray_mean = (x * self.gray_weights).sum(dim=1, keepdim=True).mean(dim=(2, 3), keepdim=True)
+        x = ((x - gray_mean) * self.random_factor(x, self.contrast) + gray_mean).clamp_(0, 1)
+        gray = (x * self.gray_weights).sum(dim=1, keepdim=True)
+        x = ((x - gray) * self.random_factor(x, self.saturation) + gray).clamp_(0, 1)
+        return x
+
+def scan_anchor_dir(anchor_dir):
+    """Restituisce (percorso anchor.png o None, positivi ordinati) leggendo la cartella una volta"""
+    anchor_path = None
+    positive_paths = []
+    with os.scandir(anchor_dir) as it:
+        for entry in it:
+            if entry.name == "anchor.png":
+                anchor_path = entry.path
+            elif entry.name.startswith("positive_") and entry.name.endswith(".png"):
+                positive_paths.append(entry.path)
+    positive_paths.sort()
+    return anchor_path, positive_paths
+
 class AirSimContrastiveDataset(Dataset):
     """
     Dataset per contrastive learning con anchor/positives da AirSim
     (Versione ottimizzata con pre-caching dei percorsi)
     """
-    def __init__(self, dataset_path, transform=None, max_samples=None):
+    def __init__(self, dataset_path, transform=None, max_samples=None, packed=False):
         self.dataset_path = dataset_path
         self.transform = transform
-        self.samples = []
+        self.anchor_paths = []
+        # Positivi di tutti gli anchor in un'unica lista piatta: quelli dell'anchor i sono
+        # positive_paths[positive_offsets[i] : positive_offsets[i] + positive_counts[i]]
+        self.positive_paths = []
+        counts = []
 
         print("Pre-caching dataset paths...")
-        # Trova tutte le cartelle anchor_XXXXX
-        anchor_dirs = sorted(glob.glob(os.path.join(dataset_path, "anchor_*")))
+        # Trova tutte le cartelle anchor_XXXXX (un solo scandir, ordinate per nome)
+        with os.scandir(dataset_path) as it:
+            anchor_dirs = sorted(e.path for e in it if e.name.startswith("anchor_") and e.is_dir())
 
         if max_samples:
             anchor_dirs = anchor_dirs[:max_samples]
 
-        for anchor_dir in anchor_dirs:
-            anchor_path = os.path.join(anchor_dir, "anchor.png")
-            positive_paths = glob.glob(os.path.join(anchor_dir, "positive_*.png"))
+        # Uno scandir per cartella al posto di exists + glob; le cartelle vengono lette in parallelo
+        # per sovrapporre la latenza di I/O (utile su storage di rete)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            listings = list(pool.map(scan_anchor_dir, anchor_dirs))
+
+        for anchor_path, positive_paths in listings:
+            if anchor_path is not None and positive_paths:
+                self.anchor_paths.append(anchor_path)
+                self.positive_paths.extend(positive_paths)
+                counts.append(len(positive_paths))
 
-            if os.path.exists(anchor_path) and positive_paths:
-                self.samples.append((anchor_path, positive_paths))
+        self.positive_counts = np.asarray(counts, dtype=np.int32)
+        self.positive_offsets = np.zeros(len(counts), dtype=np.int32)
+        np.cumsum(self.positive_counts[:-1], out=self.positive_offsets[1:])
 
-        print(f"Found {len(self.samples)} valid anchor/positive pairs.")
+        print(f"Found {len(self.anchor_paths)} valid anchor/positive pairs.")
 
-        if len(self.samples) == 0:
+        if len(self.anchor_paths) == 0:
             raise ValueError(f"No valid anchor/positive pairs found in {dataset_path}")
 
+        # Dataset impacchettato: tutti i PNG in un unico file mappato in memoria
+        self.pack_path = os.path.join(dataset_path, "dataset.bin")
+        self.pack_offsets = self.build_pack() if packed else None
+        self._pack = None  # np.memmap aperto pigramente in ogni worker (non viene serializzato)
+
+    def build_pack(self):
+        """
+        Crea (o riusa se aggiornato) dataset.bin con i byte di tutte le immagini in sequenza
+        (anchor, poi positivi) e dataset_idx.npz con gli offset: l'immagine k occupa
+        [offsets[k], offsets[k + 1]) nel blob
+        """
+        index_path = os.path.join(self.dataset_path, "dataset_idx.npz")
+        image_paths = self.anchor_paths + self.positive_paths
+        rel_paths = np.array([os.path.relpath(p, self.dataset_path) for p in image_paths])
+        file_stats = np.array([(st.st_size, st.st_mtime_ns) for st in map(os.stat, image_paths)],
+                              dtype=np.int64).reshape(-1, 2)
+
+        # Riusa il pacchetto se contiene gli stessi file, con stesse dimensioni e date di modifica
+        if os.path.exists(index_path) and os.path.exists(self.pack_path):
+            with np.load(index_path) as index:
+                if np.array_equal(index['paths'], rel_paths) and np.array_equal(index['stats'], file_stats):
+                    print(f"📦 Using packed dataset: {self.pack_path}")
+                    return index['offsets']
+
+        print(f"📦 Packing {len(image_paths)} images into {self.pack_path}...")
+        offsets = np.zeros(len(image_paths) + 1, dtype=np.int64)
+        np.cumsum(file_stats[:, 0], out=offsets[1:])
+        with open(self.pack_path + ".tmp", 'wb') as out:
+            for path in image_paths:
+                with open(path, 'rb') as f:
+                    out.write(f.read())
+        # L'indice vecchio non deve mai descrivere il pacchetto nuovo: lo si rimuove prima di sostituirlo
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        os.replace(self.pack_path + ".tmp", self.pack_path)
+        # Anche l'indice viene scritto su un file temporaneo e poi rinominato (handle esplicito: savez non aggiunge .npz)
+        with open(index_path + ".tmp", 'wb') as out:
+            np.savez(out, paths=rel_paths, stats=file_stats, offsets=offsets)
+        os.replace(index_path + ".tmp", index_path)
+        return offsets
+
+    def load_image(self, image_idx, path):
+        """Immagine uint8 (3, H, W) dal pacchetto mappato in memoria, o dal file se non impacchettato"""
+        if self.pack_offsets is None:
+            return read_image_uint8(path)
+        if self._pack is None:
+            self._pack = np.memmap(self.pack_path, dtype=np.uint8, mode='r')
+        start, end = self.pack_offsets[image_idx], self.pack_offsets[image_idx + 1]
+        data = torch.from_numpy(np.array(self._pack[start:end]))
+        return decode_image(data, mode=ImageReadMode.RGB)
+
     def __len__(self):
-        return len(self.samples)
+        return len(self.anchor_paths)
 
     def __getitem__(self, idx):
-        anchor_path, positive_paths = self.samples[idx]
+        anchor_path = self.anchor_paths[idx]
 
-        # Carica anchor
-        anchor_img = Image.open(anchor_path).convert('RGB')
+        # Carica anchor (uint8 CHW: resize, augmentation e normalizzazione avvengono su GPU)
+        anchor_img = self.load_image(idx, anchor_path)
 
-        # Scegli un positivo casuale dalla lista pre-caricata
-        positive_path = np.random.choice(positive_paths)
-        positive_img = Image.open(positive_path).convert('RGB')
+        # Scegli un positivo casuale dalla lista pre-caricata (un solo randint sull'intervallo dell'anchor)
+        positive_idx = self.positive_offsets[idx] + np.random.randint(self.positive_counts[idx])
+        positive_img = self.load_image(len(self.anchor_paths) + positive_idx, self.positive_paths[positive_idx])
 
-        # Applica trasformazioni se specificate
+        # Applica trasformazioni CPU aggiuntive se specificate
         if self.transform:
             anchor_img = self.transform(anchor_img)
             positive_img = self.transform(positive_img)
@@ -78,17 +285,17 @@ class AirSimContrastiveDataset(Dataset):
         return {
             'anchor': anchor_img,
             'positive': positive_img,
-            'anchor_dir': os.path.basename(os.path.dirname(anchor_path))
+            'anchor_dir': os.path.basename(os.path.dirname(anchor_path)),
+            'anchor_idx': idx  # identifica l'anchor anche nella negative bank
         }
 
-class L2Norm(nn.Module):
-    """Layer per normalizzazione L2"""
-    def __init__(self, dim=1):
-        super(L2Norm, self).__init__()
-        self.dim = dim
-    
-    def forward(self, x):
-        return F.normalize(x, p=2, dim=self.dim)
+def project_embeddings(features, w1, b1, w2, b2):
+    """
+    Projection head Linear -> ReLU -> Linear -> normalizzazione L2 in un'unica funzione:
+    con il modello compilato in main() Inductor fonde ReLU e normalizzazione negli epiloghi delle matmul
+    """
+    hidden = F.relu(F.linear(features, w1, b1))
+    return F.normalize(F.linear(hidden, w2, b2), p=2, dim=1)
 
 class ContrastiveEncoder(nn.Module):
     """
@@ -99,8 +306,13 @@ class ContrastiveEncoder(nn.Module):
         
         if backbone == 'resnet18':
             import torchvision.models as models
-            self.backbone = models.resnet18(pretrained=True)
-            # Rimuovi l'ultimo layer di classificazione
+            from torchvision.ops import FrozenBatchNorm2d
+            # BatchNorm congelata (statistiche ImageNet come costanti): niente scorciatoie
+            # sulle statistiche del batch di coppie, e torch.compile la fonde nelle conv
+            self.backbone = models.resnet18(weights=models.ResNet18_Weights.IMAGENET1K_V1,
+                                            norm_layer=FrozenBatchNorm2d)
+            # Rimuovi l'ultimo layer di classificazione (libera subito i 512x1000 parametri)
+            del self.backbone.fc
             self.backbone.fc = nn.Identity()
             backbone_dim = 512
         elif backbone == 'simple_cnn':
@@ -116,89 +328,211 @@ class ContrastiveEncoder(nn.Module):
         else:
             raise ValueError(f"Unknown backbone: {backbone}")
         
-        # Projection head per contrastive learning
+        # Projection head per contrastive learning (applicata da project_embeddings, con normalizzazione L2).
+        # Resta un nn.Sequential: chiavi projection_head.0.* / projection_head.2.* compatibili con i checkpoint esistenti
         self.projection_head = nn.Sequential(
             nn.Linear(backbone_dim, embedding_dim * 2),
             nn.ReLU(),
-            nn.Linear(embedding_dim * 2, embedding_dim),
-            L2Norm(dim=1)  # Normalizza gli embeddings
+            nn.Linear(embedding_dim * 2, embedding_dim)
         )
     
     def forward(self, x):
         features = self.backbone(x)
-        embeddings = self.projection_head(features)
+        fc1, fc2 = self.projection_head[0], self.projection_head[2]
+        embeddings = project_embeddings(features, fc1.weight, fc1.bias, fc2.weight, fc2.bias)
         return embeddings
 
 class ContrastiveLoss(nn.Module):
     """
-    InfoNCE Loss per contrastive learning
+    InfoNCE Loss simmetrica per contrastive learning (anchor -> positivo e positivo -> anchor)
     """
     def __init__(self, temperature=0.07):
         super(ContrastiveLoss, self).__init__()
         self.temperature = temperature
-    
-    def forward(self, anchor_embeddings, positive_embeddings):
-        # Calcola similarità coseno
-        similarity_matrix = torch.matmul(anchor_embeddings, positive_embeddings.T) / self.temperature
+        # Labels arange(B) create una volta per (device, B) direttamente sul device
+        self._labels_cache = {}
+    
+    def get_labels(self, batch_size, device):
+        key = (device, batch_size)
+        labels = self._labels_cache.get(key)
+        if labels is None:
+            # Tensore normale anche se creato in validazione: deve poter essere riusato nel backward
+            with torch.inference_mode(False):
+                labels = self._labels_cache[key] = torch.arange(batch_size, device=device)
+        return labels
+    
+    def forward(self, anchor_embeddings, positive_embeddings, negative_embeddings=None,
+                anchor_ids=None, negative_ids=None):
+        batch_size = len(anchor_embeddings)
+        
+        # Calcola similarità coseno (temperatura applicata agli anchor, B x D, invece che alla matrice)
+        # F.linear calcola anchor @ positivi.T come GEMM (M,K)x(N,K) senza vista trasposta
+        scaled_anchors = anchor_embeddings / self.temperature
+        similarity_matrix = F.linear(scaled_anchors, positive_embeddings)
+        
+        # Negativi extra (es. dalla negative bank) accodati dopo i positivi:
+        # il positivo corretto dell'anchor i resta in colonna i
+        if negative_embeddings is not None and len(negative_embeddings) > 0:
+            negative_logits = F.linear(scaled_anchors, negative_embeddings.to(positive_embeddings.dtype))
+            # Un positivo passato dello stesso anchor non è un negativo: logit a -inf
+            if anchor_ids is not None and negative_ids is not None:
+                same_anchor = anchor_ids.unsqueeze(1) == negative_ids.unsqueeze(0)
+                negative_logits = negative_logits.masked_fill(same_anchor, float('-inf'))
+            similarity_matrix = torch.cat([similarity_matrix, negative_logits], dim=1)
         
         # Labels: ogni anchor è simile al suo positivo corrispondente
-        labels = torch.arange(len(anchor_embeddings)).to(similarity_matrix.device)
+        labels = self.get_labels(batch_size, similarity_matrix.device)
         
-        # InfoNCE loss
-        loss = F.cross_entropy(similarity_matrix, labels)
+        # InfoNCE simmetrica: la direzione inversa usa il blocco B x B in-batch (i negativi della bank non hanno anchor)
+        loss = 0.5 * (F.cross_entropy(similarity_matrix, labels)
+                      + F.cross_entropy(similarity_matrix[:, :batch_size].T, labels))
         return loss
 
         # !!! manca temperatura -> qui è fissa
         # raccogliere informazioni su temperature migliori in tempo reale
 
+class NegativeBank:
+    """
+    Coda FIFO degli embeddings positivi degli ultimi K batch, usati come negativi aggiuntivi
+    (stile MoCo): K volte più negativi senza forward extra né attivazioni in più.
+    Ogni embedding è salvato con l'indice del suo anchor, così la loss può escludere
+    i positivi passati dello stesso anchor
+    """
+    def __init__(self, num_batches):
+        self.num_batches = num_batches
+        self.bank = None
+        self.ids = None
+        self.ptr = 0
+        self.filled = 0
+    
+    def negatives(self):
+        """(embeddings, indici anchor) dei negativi in coda, o (None, None) se vuota"""
+        if self.bank is None or self.filled == 0:
+            return None, None
+        return self.bank[:self.filled], self.ids[:self.filled]
+    
+    def enqueue(self, embeddings, anchor_ids):
+        embeddings = embeddings.detach().float()
+        n = embeddings.shape[0]
+        if self.bank is None:
+            # Allocata al primo batch, quando dimensione del batch ed embedding sono noti
+            self.bank = torch.zeros(self.num_batches * n, embeddings.shape[1], device=embeddings.device)
+            self.ids = torch.full((self.num_batches * n,), -1, dtype=torch.long, device=embeddings.device)
+        size = self.bank.shape[0]
+        
+        if n >= size:
+            self.bank.copy_(embeddings[-size:])
+            self.ids.copy_(anchor_ids[-size:])
+            self.ptr, self.filled = 0, size
+            return
+        
+        end = self.ptr + n
+        if end <= size:
+            self.bank[self.ptr:end] = embeddings
+            self.ids[self.ptr:end] = anchor_ids
+        else:
+            first = size - self.ptr
+            self.bank[self.ptr:] = embeddings[:first]
+            self.bank[:end - size] = embeddings[first:]
+            self.ids[self.ptr:] = anchor_ids[:first]
+            self.ids[:end - size] = anchor_ids[first:]
+        self.ptr = end % size
+        self.filled = min(size, self.filled + n)
+
+def state_to_cpu(state):
+    """Copia ricorsiva su CPU di uno state dict (anche annidato, come quello dell'optimizer)"""
+    if isinstance(state, torch.Tensor):
+        # copy=True: su CPU .cpu() restituirebbe lo stesso tensore, modificato in-place dal passo successivo
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, state_to_cpu(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(v) for v in state)
+    return state
+
+def write_checkpoint(checkpoint, filename):
+    torch.save(checkpoint, filename)
+    print(f"Checkpoint saved: {filename}")
+
 class ContrastiveTrainer:
     """
     Trainer per contrastive learning
     """
-    def __init__(self, model, train_loader, val_loader=None, lr=1e-3, weight_decay=1e-4):
+    def __init__(self, model, train_loader, val_loader=None, lr=1e-3, weight_decay=1e-4,
+                 train_transform=None, val_transform=None, negative_bank_batches=0):
         self.model = model.to(device)
         self.train_loader = train_loader
         self.val_loader = val_loader
         
-        self.optimizer = torch.optim.Adam(model.parameters(), lr=lr, weight_decay=weight_decay)
+        # Preprocessing a batch sul device (default: solo resize + normalizzazione)
+        self.train_transform = (train_transform or GpuTransform(augment=True)).to(device)
+        self.val_transform = (val_transform or GpuTransform()).to(device)
+        
+        # Ottimizzazione: Adam fused (un solo kernel per l'update di tutti i parametri, solo CUDA)
+        self.optimizer = torch.optim.Adam(model.parameters(), lr=lr, weight_decay=weight_decay,
+                                          fused=USE_CUDA)
         self.scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(self.optimizer, T_max=100)
         self.criterion = ContrastiveLoss()
         
-        # Ottimizzazione: GradScaler per Automatic Mixed Precision (AMP) - API aggiornata
-        self.scaler = torch.amp.GradScaler(enabled=torch.cuda.is_available())
+        # Negative bank (solo training): 0 = solo negativi in-batch
+        self.negative_bank = NegativeBank(negative_bank_batches) if negative_bank_batches > 0 else None
+        
+        # Ottimizzazione: dtype AMP (bf16 se supportato) e GradScaler solo per fp16 - API aggiornata
+        self.amp_dtype = AMP_DTYPE
+        if self.amp_dtype == torch.float16:
+            self.scaler = torch.amp.GradScaler(enabled=USE_CUDA)
+        else:
+            self.scaler = None
         
         self.train_losses = []
         self.val_losses = []
+        
+        # Salvataggi dei checkpoint su un thread dedicato: torch.save non blocca l'epoca successiva
+        self._save_executor = ThreadPoolExecutor(max_workers=1)
+        self._pending_saves = []
     
     def train_epoch(self):
         self.model.train()
-        total_loss = 0
+        # Loss accumulata sul device: una sola sincronizzazione a fine epoca invece di una per batch
+        total_loss = torch.zeros((), device=device)
         num_batches = 0
         
         for batch in self.train_loader:
-            anchor_imgs = batch['anchor'].to(device)
-            positive_imgs = batch['positive'].to(device)
+            # Trasferimento uint8 (4x meno dati di float32), poi preprocessing su GPU
+            with torch.no_grad():
+                imgs = self.train_transform(pair_to_device(batch))
+            anchor_ids = batch['anchor_idx'].to(device, non_blocking=True)
             
-            self.optimizer.zero_grad()
+            self.optimizer.zero_grad(set_to_none=True)
             
             # Ottimizzazione: Automatic Mixed Precision (AMP) - API aggiornata
-            with torch.amp.autocast(device_type='cuda', dtype=torch.float16, enabled=torch.cuda.is_available()):
-                # Forward pass
-                anchor_embeddings = self.model(anchor_imgs)
-                positive_embeddings = self.model(positive_imgs)
+            with torch.amp.autocast(device_type=AMP_DEVICE, dtype=self.amp_dtype, enabled=USE_CUDA):
+                # Forward pass unico su anchor + positivi (2B)
+                anchor_embeddings, positive_embeddings = self.model(imgs).chunk(2, dim=0)
                 
-                # Calculate loss
-                loss = self.criterion(anchor_embeddings, positive_embeddings)
+                # Calculate loss (con i negativi della bank, se attiva)
+                negatives, negative_ids = (self.negative_bank.negatives() if self.negative_bank is not None
+                                           else (None, None))
+                loss = self.criterion(anchor_embeddings, positive_embeddings, negatives,
+                                      anchor_ids, negative_ids)
             
-            # Backward pass con scaler
-            self.scaler.scale(loss).backward()
-            self.scaler.step(self.optimizer)
-            self.scaler.update()
+            if self.negative_bank is not None:
+                self.negative_bank.enqueue(positive_embeddings, anchor_ids)
             
-            total_loss += loss.item()
+            if self.scaler is not None:
+                # Backward pass con scaler (fp16)
+                self.scaler.scale(loss).backward()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+            else:
+                # bf16: nessun loss scaling, niente controllo overflow sui gradienti
+                loss.backward()
+                self.optimizer.step()
+            
+            total_loss += loss.detach().float()
             num_batches += 1
         
-        avg_loss = total_loss / num_batches
+        avg_loss = (total_loss / num_batches).item()
         return avg_loss
     
     def validate(self):
@@ -206,25 +540,24 @@ class ContrastiveTrainer:
             return None
         
         self.model.eval()
-        total_loss = 0
+        total_loss = torch.zeros((), device=device)
         num_batches = 0
         
-        with torch.no_grad():
+        # inference_mode: niente version counter né tracking delle view (più leggero di no_grad)
+        with torch.inference_mode():
             for batch in self.val_loader:
-                anchor_imgs = batch['anchor'].to(device)
-                positive_imgs = batch['positive'].to(device)
+                imgs = self.val_transform(pair_to_device(batch))
                 
                 # Ottimizzazione: AMP anche in validazione per coerenza - API aggiornata
-                with torch.amp.autocast(device_type='cuda', dtype=torch.float16, enabled=torch.cuda.is_available()):
-                    anchor_embeddings = self.model(anchor_imgs)
-                    positive_embeddings = self.model(positive_imgs)
+                with torch.amp.autocast(device_type=AMP_DEVICE, dtype=self.amp_dtype, enabled=USE_CUDA):
+                    anchor_embeddings, positive_embeddings = self.model(imgs).chunk(2, dim=0)
                     
                     loss = self.criterion(anchor_embeddings, positive_embeddings)
                 
-                total_loss += loss.item()
+                total_loss += loss.float()
                 num_batches += 1
         
-        avg_loss = total_loss / num_batches
+        avg_loss = (total_loss / num_batches).item()
         return avg_loss
     
     def train(self, num_epochs):
@@ -253,16 +586,26 @@ class ContrastiveTrainer:
             if (epoch + 1) % 10 == 0:
                 self.save_checkpoint(f"checkpoint_epoch_{epoch+1}.pth")
         
+        self.wait_for_checkpoints()
         print("Training completed!")
     
     def save_checkpoint(self, filename):
-        torch.save({
-            'model_state_dict': self.model.state_dict(),
-            'optimizer_state_dict': self.optimizer.state_dict(),
-            'train_losses': self.train_losses,
-            'val_losses': self.val_losses,
-        }, filename)
-        print(f"Checkpoint saved: {filename}")
+        # Copia su CPU sincrona (i pesi cambiano al passo successivo), serializzazione in background
+        checkpoint = {
+            'model_state_dict': state_to_cpu(self.model.state_dict()),
+            'optimizer_state_dict': state_to_cpu(self.optimizer.state_dict()),
+            'train_losses': list(self.train_losses),
+            'val_losses': list(self.val_losses),
+        }
+        future = self._save_executor.submit(write_checkpoint, checkpoint, filename)
+        self._pending_saves.append(future)
+        return future
+    
+    def wait_for_checkpoints(self):
+        """Attende i salvataggi in corso e propaga eventuali errori"""
+        pending, self._pending_saves = self._pending_saves, []
+        for future in pending:
+            future.result()
     
     def plot_losses(self, save_path=None):
         plt.figure(figsize=(10, 6))
@@ -279,24 +622,40 @@ class ContrastiveTrainer:
             plt.savefig(save_path)
         plt.show()
 
+def warmup_model(model, batch_size, img_size=224, eval_batch_sizes=()):
+    """
+    Forward + backward su un batch fittizio per pagare la compilazione fuori dal loop di training,
+    più un forward in inference_mode per ogni forma di batch della validazione (incluso l'ultimo parziale)
+    (i buffer, es. statistiche BatchNorm, vengono ripristinati: il warmup non altera il modello)
+    """
+    def dummy_batch(n):
+        return torch.randn(n, 3, img_size, img_size, device=device).contiguous(memory_format=torch.channels_last)
+    
+    model.to(device).train()
+    buffers = copy.deepcopy(model.state_dict())
+    
+    # Stesso dtype AMP del training, così il grafo compilato viene riutilizzato
+    with torch.amp.autocast(device_type=AMP_DEVICE, dtype=AMP_DTYPE, enabled=USE_CUDA):
+        embeddings = model(dummy_batch(batch_size))
+    embeddings.float().sum().backward()
+    model.zero_grad(set_to_none=True)
+    
+    # Validazione: grafo separato (eval + inference_mode), uno per ogni dimensione di batch
+    model.eval()
+    with torch.inference_mode(), torch.amp.autocast(device_type=AMP_DEVICE, dtype=AMP_DTYPE, enabled=USE_CUDA):
+        for n in eval_batch_sizes:
+            model(dummy_batch(n))
+    model.train()
+    
+    model.load_state_dict(buffers)
+
 def get_transforms(img_size=224):
     """
-    Definisce le trasformazioni per le immagini
+    Definisce le trasformazioni per le immagini (eseguite a batch sul device)
     """
-    train_transform = transforms.Compose([
-        transforms.Resize((img_size, img_size)),
-        transforms.RandomHorizontalFlip(p=0.5),
-        transforms.RandomRotation(degrees=5),
-        transforms.ColorJitter(brightness=0.1, contrast=0.1, saturation=0.1, hue=0.05),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])
-    
-    val_transform = transforms.Compose([
-        transforms.Resize((img_size, img_size)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])
+    train_transform = GpuTransform(img_size, augment=True, degrees=5,
+                                   brightness=0.1, contrast=0.1, saturation=0.1, hue=0.05)
+    val_transform = GpuTransform(img_size)
     
     return train_transform, val_transform
 
@@ -316,6 +675,11 @@ def main():
                         help='Maximum number of samples to use (for testing)')
     parser.add_argument('--val_split', type=float, default=0.2, 
                         help='Validation split ratio')
+    parser.add_argument('--pack_dataset', action='store_true', 
+                        help='Pack all images into a single memory-mapped file (dataset.bin)')
+    parser.add_argument('--negative_bank_batches', type=int, default=4, 
+                        help='Number of past batches kept as extra negatives (0 = in-batch only; '
+                             'past positives of the same anchor are masked out)')
     
     args = parser.parse_args()
     
@@ -338,10 +702,13 @@ def main():
         NUM_WORKERS = os.cpu_count() // 2 if os.cpu_count() > 1 else 0
 
     # Abilita TF32 per GPU Ampere (velocizza ulteriormente senza perdita di precisione)
-    if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8:
+    if USE_CUDA and torch.cuda.get_device_capability()[0] >= 8:
         torch.backends.cuda.matmul.allow_tf32 = True
         torch.backends.cudnn.allow_tf32 = True
     
+    # Input a forma fissa: cuDNN sceglie l'algoritmo di convoluzione più veloce al primo batch
+    torch.backends.cudnn.benchmark = True
+    
     # --- Fine Ottimizzazioni Main ---
 
     # Path al dataset
@@ -357,11 +724,11 @@ def main():
     # Preparazione transforms
     train_transform, val_transform = get_transforms()
     
-    # Carica dataset completo
+    # Carica dataset completo (immagini uint8 grezze, trasformazioni applicate dal trainer)
     full_dataset = AirSimContrastiveDataset(
         dataset_path, 
-        transform=train_transform, 
-        max_samples=args.max_samples
+        max_samples=args.max_samples,
+        packed=args.pack_dataset
     )
     
     # Split train/validation
@@ -373,18 +740,22 @@ def main():
         full_dataset, [train_size, val_size]
     )
     
-    # Aggiorna transform per validation
-    val_dataset.dataset.transform = val_transform
-    
     print(f"📊 Dataset split - Train: {train_size}, Val: {val_size}")
     
+    # Ottimizzazione: worker persistenti tra le epoche e prefetch di più batch
+    # (consentiti solo con num_workers > 0)
+    loader_kwargs = {'persistent_workers': True, 'prefetch_factor': 4} if NUM_WORKERS > 0 else {}
+    
     # Data loaders
     train_loader = DataLoader(
         train_dataset, 
         batch_size=args.batch_size, 
         shuffle=True, 
         num_workers=NUM_WORKERS,
-        pin_memory=True # Ottimizzazione: trasferimenti più veloci a GPU
+        collate_fn=collate_uint8,
+        drop_last=train_size >= args.batch_size, # Forma del batch fissa per il modello compilato
+        pin_memory=True, # Ottimizzazione: trasferimenti più veloci a GPU
+        **loader_kwargs
     )
     
     val_loader = DataLoader(
@@ -392,7 +763,9 @@ def main():
         batch_size=args.batch_size, 
         shuffle=False, 
         num_workers=NUM_WORKERS,
-        pin_memory=True # Ottimizzazione: trasferimenti più veloci a GPU
+        collate_fn=collate_uint8,
+        pin_memory=True, # Ottimizzazione: trasferimenti più veloci a GPU
+        **loader_kwargs
     )
     
     # Modello
@@ -401,15 +774,31 @@ def main():
         backbone=args.backbone
     )
     
+    # Ottimizzazione: pesi in channels_last, coerenti con gli input prodotti da GpuTransform
+    model = model.to(device, memory_format=torch.channels_last)
+    
     # Ottimizzazione: Compila il modello con torch.compile (per PyTorch 2.0+)
     # NOTA: La compilazione viene saltata su Windows se si usano i worker (num_workers > 0)
     # per evitare problemi di compatibilità con il multiprocessing.
     if NUM_WORKERS == 0 or os.name != 'nt':
+        # Forme dei batch (anchor + positivi concatenati): train senza l'ultimo parziale (drop_last),
+        # validazione con batch pieni e ultimo batch parziale
+        train_batch = 2 * min(args.batch_size, train_size)
+        val_batches = {2 * min(args.batch_size, val_size), 2 * (val_size % args.batch_size)} - {0}
         try:
-            model = torch.compile(model)
+            # Durante il warmup gli errori di compilazione devono arrivare all'except (niente fallback silenzioso)
+            torch._dynamo.config.suppress_errors = False
+            # Shape statiche (batch_size fisso): max-autotune sceglie i kernel migliori per questa forma
+            compiled_model = torch.compile(model, mode="max-autotune", fullgraph=True, dynamic=False)
+            # La compilazione è lazy: i batch di warmup la eseguono (e ne rivelano gli errori) prima del training
+            warmup_model(compiled_model, train_batch, train_transform.img_size, sorted(val_batches))
+            model = compiled_model
             print("🚀 Model compiled successfully with torch.compile()!")
         except Exception as e:
+            torch._dynamo.reset()
             print(f"⚠️ Could not compile model with torch.compile(): {e}. Running un-optimized model.")
+        finally:
+            torch._dynamo.config.suppress_errors = True
     else:
         print("⚠️ Skipping torch.compile() on Windows with num_workers > 0 to ensure compatibility.")
 
@@ -421,7 +810,10 @@ def main():
         model=model,
         train_loader=train_loader,
         val_loader=val_loader,
-        lr=args.lr
+        lr=args.lr,
+        train_transform=train_transform,
+        val_transform=val_transform,
+        negative_bank_batches=args.negative_bank_batches
     )
     
     # Training
@@ -432,6 +824,7 @@ def main():
     # Salva modello finale
     final_model_path = f"contrastive_model_final_{timestamp}.pth"
     trainer.save_checkpoint(final_model_path)
+    trainer.wait_for_checkpoints()
     
     # Plot delle loss
     plot_path = f"training_losses_final_{timestamp}.png"